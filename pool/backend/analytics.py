@@ -0,0 +1,54 @@
+'''
+Defines the backend analytics APIs
+'''
+import math
+from flask import Blueprint
+from pool.utils.flask_utils import *
+from pool.utils import chemistry
+from pool import chlorine
+from pool.backend import dal
+from pool.backend.readings import readings_validator
+
+analytics = Blueprint('analytics', __name__)
+
+
+def _to_json(series):
+    '''Converts a series to a list, with null for NaN and infinities'''
+    return [v if math.isfinite(v) else None for v in series.tolist()]
+
+
+@analytics.route('/')
+@conditional(readings_validator)
+@return_json
+def get_chemistry():
+    '''Returns water chemistry derived from each reading in [after, before],
+    oldest first, as {'ts': [...], 'lsi': [...], 'fc_cya': [...], 'cc': [...]}:
+    the Langelier Saturation Index, free chlorine to CYA ratio and combined
+    chlorine. Values not measured in a reading are taken from the last one
+    which measured them, even if it is before after; null where unknown.
+    '''
+    after = extract_int('after', 0)
+    before = extract_int('before', int(1000 * time.time()))
+
+    columns = dal.get_readings_columns(after, before,
+                                       ['ts'] + chemistry.COLUMNS)
+    seeds = {c: value for c, (_, value) in
+             dal.get_values_before(after, chemistry.COLUMNS).items()}
+    series = chemistry.water_chemistry(columns, seeds)
+
+    result = {'ts': columns['ts'][0].tolist()}
+    for name, values in series.items():
+        result[name] = _to_json(values)
+    return result
+
+
+@analytics.route('/chlorine')
+@return_json
+def get_chlorine():
+    '''Returns the fitted decay of free chlorine after each dose and the
+    current estimate of demand and dosing, as {'segments', 'estimate'};
+    see chlorine.get_segments and chlorine.get_estimate'''
+    return {
+        'segments': chlorine.get_segments(),
+        'estimate': chlorine.get_estimate(),
+    }
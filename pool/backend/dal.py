@@ -1,27 +1,100 @@
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import desc, event
+from sqlalchemy import cast, desc, event, func, inspect, or_
 from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
+from sqlalchemy.pool import QueuePool
+import numpy as np
+import fcntl
+import itertools
+import os
+import tempfile
+import threading
 import time
 
 from pool import app
+from pool.utils import instrumentation, pubsub
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///backend/pool.db'
+# POOL_DATABASE_URI points tests and benchmarks at a database of their own;
+# it has to be set before pool is imported, since the database is set up then
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
+    'POOL_DATABASE_URI', 'sqlite:///backend/pool.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# keep connections (and their pragmas and page cache) open across requests;
+# writers wait up to timeout (s) for the write lock instead of failing
+app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {
+    'poolclass': QueuePool,
+    'pool_size': 5,
+    'max_overflow': 5,
+    'connect_args': {'check_same_thread': False, 'timeout': 15},
+})
+# one of STORAGE_PROFILES
+app.config.setdefault('POOL_STORAGE_PROFILE', 'wal')
+# buffered readings are flushed once this many are waiting...
+app.config.setdefault('POOL_INGEST_BATCH_SIZE', 10)
+# ...or once the oldest has waited this long (s)
+app.config.setdefault('POOL_INGEST_MAX_AGE', 300)
+# readings processed per transaction by migrations which touch every reading
+app.config.setdefault('POOL_MIGRATION_BATCH_SIZE', 50000)
+# how often old readings are compacted (s), and readings deleted per
+# transaction when they are; see compact_readings
+app.config.setdefault('POOL_COMPACTION_INTERVAL', 60 * 60)
+app.config.setdefault('POOL_COMPACTION_BATCH_SIZE', 5000)
 
 db = SQLAlchemy(app)
 
-DATABASE_VERSION = 1
+DATABASE_VERSION = 4
+
+# pragmas set on each connection, by storage profile
+STORAGE_PROFILES = {
+    # SQLite's defaults: a rollback journal, under which a long read
+    # (such as a CSV export) blocks writers until it finishes
+    'default': [],
+    # a write-ahead log lets readers and the writer proceed concurrently;
+    # with WAL, synchronous=NORMAL only fsyncs at checkpoints
+    'wal': [
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('cache_size', -8000),  # KiB
+        ('mmap_size', 64 * 1024 * 1024),
+        ('temp_store', 'MEMORY'),
+    ],
+}
 
 
-@event.listens_for(Engine, "connect")
-def set_sqlite_pragmas(dbapi_connection, connection_record):
-    '''defines pragmas for use with the database connection'''
+def apply_storage_profile(dbapi_connection, profile):
+    '''Sets the pragmas of a storage profile on a DB-API connection'''
     cursor = dbapi_connection.cursor()
     cursor.execute('PRAGMA foreign_keys=ON')
+    # lets compact_readings return freed pages to the filesystem. This only
+    # takes effect on new databases; older ones are converted by _migrate_to_4
+    cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    for pragma, value in STORAGE_PROFILES[profile]:
+        cursor.execute('PRAGMA {}={}'.format(pragma, value))
     cursor.close()
 
 
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    '''defines pragmas for use with the database connection'''
+    apply_storage_profile(dbapi_connection, app.config['POOL_STORAGE_PROFILE'])
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and instrumentation.enabled():
+        context._query_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _finish_query(conn, cursor, statement, parameters, context, executemany):
+    '''times queries for instrumentation.record_query'''
+    start = getattr(context, '_query_start', None)
+    if start is not None:
+        instrumentation.record_query(time.perf_counter() - start)
+
+
 def as_dict(db_model):
     '''Returns a db model object as a dict'''
     return {c.name: getattr(db_model, c.name) for c in db_model.__table__.columns}
@@ -76,7 +149,7 @@ class Reading(db.Model):
     def __init__(self, **kwargs):
         bad_args = [arg for arg in kwargs if arg not in self.info]
         if any(bad_args):
-            raise Exception('kwargs includes unknown arguments: ' +
+            raise DalException('kwargs includes unknown arguments: ' +
                             ', '.join(bad_args))
         self.ts = get_or_default(kwargs, 'ts', int(time.time() * 1000))
         self.fc = get_or_default(kwargs, 'fc')
@@ -98,6 +171,137 @@ class Reading(db.Model):
         return '\n'.join([str(e) for e in self.events])
 
 
+# columns which are only filled in by manual readings, and so are null for
+# most rows; each gets a partial index so the newest value is found without
+# walking back through sensor readings (see get_most_recent)
+SPARSE_COLUMNS = ['fc', 'tc', 'ta', 'ca', 'cya']
+for _c in SPARSE_COLUMNS:
+    db.Index('ix_reading_{}_ts'.format(_c), Reading.ts,
+             sqlite_where=getattr(Reading, _c) != None)
+
+
+HOUR_MS = 60 * 60 * 1000
+DAY_MS = 24 * HOUR_MS
+# reading columns summarized by the rollup tables
+ROLLUP_COLUMNS = [d[0] for d in Reading.definitions if d[0] != 'ts']
+
+
+def _rollup_table(name):
+    '''Defines a rollup table, which has one row per time bucket.
+    bucket is the bucket's start (ms since epoch) and count is the number
+    of readings in it; every reading column then has a _min, _max, _sum
+    and _count (of non-null values), from which the mean is derived.
+    '''
+    cols = [db.Column('bucket', db.Integer, primary_key=True),
+            db.Column('count', db.Integer)]
+    for col in ROLLUP_COLUMNS:
+        cols += [db.Column(col + '_min', db.Float),
+                 db.Column(col + '_max', db.Float),
+                 db.Column(col + '_sum', db.Float),
+                 db.Column(col + '_count', db.Integer)]
+    return db.Table(name, *cols)
+
+
+reading_hourly = _rollup_table('reading_hourly')
+reading_daily = _rollup_table('reading_daily')
+# rollup tables from finest to coarsest, with their bucket width in ms
+ROLLUPS = [
+    (reading_hourly, HOUR_MS),
+    (reading_daily, DAY_MS),
+]
+
+
+def _rollup_query(width, source):
+    '''Returns (ts, query), where query aggregates source into buckets of
+    width ms, selecting columns in the order of a rollup table, and ts is
+    the source's time column. source is either a finer rollup table or
+    None, meaning the raw readings.
+    '''
+    if source is None:
+        ts = Reading.ts
+        aggregates = [func.count(ts)]
+        for name in ROLLUP_COLUMNS:
+            col = getattr(Reading, name)
+            aggregates += [func.min(col), func.max(col),
+                           func.sum(col), func.count(col)]
+    else:
+        ts = source.c.bucket
+        aggregates = [func.sum(source.c.count)]
+        for name in ROLLUP_COLUMNS:
+            aggregates += [func.min(source.c[name + '_min']),
+                           func.max(source.c[name + '_max']),
+                           func.sum(source.c[name + '_sum']),
+                           func.sum(source.c[name + '_count'])]
+    bucket = ts - ts % width
+    return ts, db.session.query(bucket, *aggregates).group_by(bucket)
+
+
+def _refresh_rollups(after, before):
+    '''Recomputes every rollup bucket overlapping [after, before],
+    each level from the one below it, so that they reflect readings
+    added, changed or deleted in that window. Does not commit.
+    '''
+    db.session.flush()
+    # buckets of compacted readings can't be recomputed from what is left
+    after = max(after, _settings['raw_compacted_before'])
+    if after > before:
+        return
+    source = None
+    for table, width in ROLLUPS:
+        start = after - after % width
+        end = before - before % width + width
+        ts, query = _rollup_query(width, source)
+        db.session.execute(table.delete().where(table.c.bucket >= start)
+                                         .where(table.c.bucket < end))
+        db.session.execute(table.insert().from_select(
+            [c.name for c in table.columns],
+            query.filter(ts >= start, ts < end).statement))
+        source = table
+
+
+def _in_reading_batches(step, batch_size=None):
+    '''Calls step(first_ts, last_ts) over consecutive ranges of readings,
+    each holding at most batch_size of them (default
+    POOL_MIGRATION_BATCH_SIZE), committing and printing progress after
+    each. Ranges are found by ts from where the previous one ended, so
+    every batch costs the same however large the table is.
+    '''
+    batch_size = batch_size or app.config['POOL_MIGRATION_BATCH_SIZE']
+    total = db.session.query(func.count(Reading.ts)).scalar()
+    done = 0
+    first = db.session.query(func.min(Reading.ts)).scalar()
+    start = time.time()
+    while first is not None:
+        in_batch = Reading.query.filter(Reading.ts >= first)\
+            .order_by(Reading.ts)\
+            .with_entities(Reading.ts)
+        last = in_batch.offset(batch_size - 1).limit(1).scalar()
+        if last is None:
+            last = db.session.query(func.max(Reading.ts)).scalar()
+            done = total
+        else:
+            done += batch_size
+        step(first, last)
+        db.session.commit()
+        print('  {}/{} readings ({:.0f}%) in {:.1f} s'
+              .format(done, total, 100 * done / total, time.time() - start))
+        first = in_batch.filter(Reading.ts > last).limit(1).scalar()
+
+
+def rebuild_rollups():
+    '''Rebuilds the rollup tables from all stored readings'''
+    for table, _ in ROLLUPS:
+        db.session.execute(table.delete())
+    _in_reading_batches(_refresh_rollups)
+    db.session.commit()
+
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    '''Rebuilds the reading rollup tables from existing readings'''
+    rebuild_rollups()
+
+
 EVENT_TYPES = {
     'ADD-CL': ('Added chlorine', 'gal'),
     'ADD-ACID': ('Added acid', 'gal'),
@@ -130,7 +334,12 @@ class Event(db.Model):
     comment = db.Column(db.Text)
 
     reading_ts = db.Column(db.Integer,
-                           db.ForeignKey('reading.ts', ondelete='CASCADE'))
+                           db.ForeignKey('reading.ts', ondelete='CASCADE'),
+                           index=True)
+
+    __table_args__ = (
+        db.Index('ix_event_event_type_reading_ts', 'event_type', 'reading_ts'),
+    )
 
     definitions = [
         ('event_type', 'Event Type', ''),
@@ -175,7 +384,24 @@ SETTINGS_TYPES = {
     # how for the temp should drift before update
     'compensation_delta': (int, 1),
     # current db version
-    'database_version': (int, 1),
+    'database_version': (int, DATABASE_VERSION),
+    # how long readings are kept (days, or 0 for ever): raw readings, and
+    # their hourly and daily rollups. See compact_readings
+    'raw_retention_days': (int, 0),
+    'hourly_retention_days': (int, 2 * 365),
+    'daily_retention_days': (int, 0),
+    # pool volume (gal), strength of the chlorine added (% available
+    # chlorine) and the free chlorine to keep (ppm); see pool.chlorine
+    'pool_volume': (int, 15000),
+    'chlorine_strength': (float, 10.0),
+    'fc_target': (float, 5.0),
+    # raw readings and hourly rollups before these (ms since epoch) may
+    # have been deleted by compact_readings
+    'raw_compacted_before': (int, 0),
+    'hourly_compacted_before': (int, 0),
+    # bumped by every change to settings, so that each process can tell
+    # when another has changed them; see refresh_settings
+    'settings_version': (int, 0),
 }
 
 
@@ -216,45 +442,438 @@ class Setting(db.Model):
         return converter(self.value)
 
 
+# data_change rows kept; processes which fall further behind than this
+# reload everything (see _catch_up)
+DATA_CHANGES_KEPT = 1000
+
+
+class DataChange(db.Model):
+    '''A change to readings or events with ts in [after, before], made by
+    any process at at (s since epoch), and the event_id of the event it
+    added, if any. version increases by one with every change, so each
+    process can tell which it has not seen; see _catch_up.
+    '''
+    __tablename__ = 'data_change'
+    version = db.Column(db.Integer, primary_key=True)
+    after = db.Column(db.Integer)
+    before = db.Column(db.Integer)
+    at = db.Column(db.Float)
+    event_id = db.Column(db.Integer)
+
+
+def _create_indexes(table, names):
+    '''Creates the named indexes of a table, unless they exist'''
+    connection = db.session.connection()
+    existing = {i['name'] for i in inspect(connection).get_indexes(table.name)}
+    for index in table.indexes:
+        if index.name in names and index.name not in existing:
+            index.create(connection)
+
+
+def _migrate_to_2():
+    '''Indexes events by reading and by type, and sparse reading columns'''
+    _create_indexes(Event.__table__, ['ix_event_reading_ts',
+                                      'ix_event_event_type_reading_ts'])
+    _create_indexes(Reading.__table__, ['ix_reading_{}_ts'.format(c)
+                                        for c in SPARSE_COLUMNS])
+
+
+def _migrate_to_3():
+    '''Fills in the rollup tables for readings stored before they existed'''
+    rebuild_rollups()
+
+
+def _migrate_to_4():
+    '''Switches the database to incremental auto vacuum, which means
+    rewriting it with VACUUM; this can't be done in batches'''
+    db.session.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    db.session.execute('VACUUM')
+
+
+# ordered (version, description, step), where each step migrates the
+# database to that version from the one before it. The new version is
+# only recorded once a step succeeds, but a failed step may leave some of
+# its work committed: SQLite commits DDL such as CREATE INDEX (and VACUUM)
+# as it runs, and steps which touch every reading work in batches (see
+# _in_reading_batches), each committed. So every step must be safe to
+# rerun on a database it has partly migrated.
+MIGRATIONS = [
+    (2, 'index event lookups and sparse reading columns', _migrate_to_2),
+    (3, 'backfill reading rollups', _migrate_to_3),
+    (4, 'enable incremental vacuum', _migrate_to_4),
+]
+
+
+def _migrate(version):
+    '''Migrates the database from version to DATABASE_VERSION'''
+    if version > DATABASE_VERSION:
+        raise DalException('DB version {} is newer than this code ({})'
+                           .format(version, DATABASE_VERSION))
+    for to_version, description, step in MIGRATIONS:
+        if to_version <= version:
+            continue
+        print('Migrating database to version {}: {}'
+              .format(to_version, description))
+        start = time.time()
+        try:
+            step()
+            Setting.query.filter_by(name='database_version')\
+                .update({Setting.value: str(to_version)})
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            raise DalException('Migration to version {} failed: {}'
+                               .format(to_version, e)) from e
+        print('Migrated to version {} in {:.1f} s'
+              .format(to_version, time.time() - start))
+
+
+def lock_path(name):
+    '''Returns the path of a lock file for name, beside the database so
+    that each database gets its own (or in the temporary directory, if
+    it is not a file)'''
+    database = db.engine.url.database
+    if not database or database == ':memory:':
+        return os.path.join(tempfile.gettempdir(), 'pool.{}.lock'.format(name))
+    return '{}.{}.lock'.format(database, name)
+
+
 def _setup_database():
     '''
     Performs initial database setup. It is safe to call
     this method even after the database has been set up.
-    If the database version has changed from the value
-    stored in the database, then this method throws; in
-    that case, a migration procedure should be developed. 
+    If the database version stored in the database is
+    older than DATABASE_VERSION, the database is migrated
+    (see MIGRATIONS).
     This is automatically called upon import.
+    Processes (such as WSGI workers) set up one at a time, so only the
+    first migrates and the rest find the database up to date.
     '''
-    db.create_all()
-
-    # check database version
-    cur_version = Setting.query.get('database_version')
-    if cur_version != None:
-        if cur_version.get_value() == DATABASE_VERSION:
-            return
-        raise Exception('DB needs schema migration from {} to {}'
-                        .format(cur_version.get_version(), DATABASE_VERSION))
-
-    # initilize settings
-    for name in SETTINGS_TYPES:
-        _, initial = SETTINGS_TYPES[name]
-        s = Setting(name, str(initial))
-        db.session.add(s)
-    db.session.commit()
+    with open(lock_path('setup'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        db.create_all()
+
+        # initilize settings, including any added since the database was made
+        for name in SETTINGS_TYPES:
+            if Setting.query.get(name) is None:
+                _, initial = SETTINGS_TYPES[name]
+                db.session.add(Setting(name, str(initial)))
+        db.session.commit()
+        _load_settings()
+
+        _migrate(_settings['database_version'])
+        _load_settings()
+
+
+def _load_settings():
+    # updated in place, never cleared, so readers never see it half loaded
+    _settings.update({s.name: s.get_value() for s in Setting.query.filter().all()})
+
+
+def _load_latest(columns, before=None):
+    '''Queries the most recent non-null value of each column, from
+    readings before before if given, as {column: (ts, value)}, with
+    (None, None) if it has none'''
+    query = Reading.query
+    if before is not None:
+        query = query.filter(Reading.ts < before)
+    newest = db.session.query(*[
+        query.with_entities(Reading.ts)
+        .filter(getattr(Reading, c) != None)
+        .order_by(desc(Reading.ts))
+        .limit(1)
+        .as_scalar()
+        for c in columns
+    ]).one()
+    readings = Reading.query\
+        .filter(Reading.ts.in_([ts for ts in newest if ts is not None]))\
+        .all()
+    by_ts = {r.ts: r for r in readings}
+    return {c: (ts, getattr(by_ts[ts], c)) if ts in by_ts else (None, None)
+            for c, ts in zip(columns, newest)}
 
 
+# every setting's value, by name; see get_settings
+_settings = {}
 _setup_database()
-_settings = {s.name: s.get_value() for s in Setting.query.filter().all()}
+# cache of the most recent value of each reading column; see get_latest_values
+_latest = _load_latest(ROLLUP_COLUMNS)
+_latest_lock = threading.Lock()
+# the newest change to readings or events this process has caught up
+# with, as (version, when it was made); see _catch_up
+_data_stamp = db.session.query(DataChange.version, DataChange.at)\
+    .order_by(desc(DataChange.version)).first() or (0, time.time())
+# the ts of the newest reading published to hub
+_published_ts = db.session.query(func.max(Reading.ts)).scalar()
+_published_ts = -1 if _published_ts is None else _published_ts
+_catch_up_lock = threading.Lock()
+# functions called with (after, before) on every change; see on_change
+_change_listeners = []
+
+
+def on_change(listener):
+    '''Registers listener(after, before) to be called after readings or
+    events with ts in [after, before] are changed, by any process.
+    Returns listener, so this can be used as a decorator.'''
+    _change_listeners.append(listener)
+    return listener
+
+
+def _stamp_change(after, before, event_id=None):
+    '''Records a change to readings or events with ts in [after, before]
+    in the data_change table, as part of the transaction making it.
+    Call _catch_up once it is committed.'''
+    change = DataChange(after=after, before=before, at=time.time(),
+                        event_id=event_id)
+    db.session.add(change)
+    db.session.flush()
+    if change.version % DATA_CHANGES_KEPT == 0:
+        DataChange.query.filter(DataChange.version <= change.version - DATA_CHANGES_KEPT)\
+            .delete(synchronize_session=False)
+
+
+# receives ('reading', dict) for each reading buffered by this process,
+# or stored by another with a ts newer than any before it, and
+# ('event', dict) for each event added, once committed by any process;
+# see readings.stream_readings
+hub = pubsub.Hub()
+# ts of readings published to hub when buffered, which are not published
+# again once stored
+_published_pending = set()
+
+
+def _catch_up():
+    '''Brings this process's caches up to date with the changes to
+    readings and events made since it last did, by any process: latest
+    values are reloaded, new readings and events published to hub, and
+    the on_change listeners called for each change. If this process has
+    fallen so far behind that some changes were pruned, listeners are
+    called once for every ts instead, and nothing is published.
+    '''
+    global _data_stamp, _published_ts
+    with _catch_up_lock:
+        changes = DataChange.query.filter(DataChange.version > _data_stamp[0])\
+            .order_by(DataChange.version).all()
+        if not any(changes):
+            return
+        complete = changes[0].version == _data_stamp[0] + 1
+        if complete:
+            ranges = [(c.after, c.before) for c in changes]
+            readings = Reading.query.filter(Reading.ts > _published_ts)\
+                .order_by(Reading.ts).all()
+            added = {c.event_id for c in changes if c.event_id is not None}
+            events = Event.query.filter(Event.event_id.in_(added))\
+                .order_by(Event.event_id).all() if added else []
+        else:
+            ranges = [(0, 2 ** 62)]
+            readings = Reading.query.order_by(desc(Reading.ts)).limit(1).all()
+            events = []
+
+        # readings newer than any seen before are applied below
+        for after, before in ranges:
+            if after <= _published_ts:
+                _invalidate_latest(after, min(before, _published_ts))
+        for r in readings:
+            _update_latest(r)
+            if complete and r.ts not in _published_pending:
+                hub.publish(('reading', as_dict(r)))
+        for e in events:
+            message = as_dict(e)
+            message['text'] = str(e)
+            hub.publish(('event', message))
+
+        if any(readings):
+            _published_ts = readings[-1].ts
+        _data_stamp = (changes[-1].version, changes[-1].at)
+        for after, before in ranges:
+            for listener in _change_listeners:
+                listener(after, before)
+
+
+def get_data_version():
+    '''Returns (version, modified): a string which changes whenever the
+    stored readings or events do, whichever process changes them, and
+    when they last changed (s since epoch). This is as of the last call
+    to refresh_settings, which is made before every request.
+    '''
+    version, modified = _data_stamp
+    return str(version), modified
+
+
+def _update_latest(reading):
+    '''Updates the latest value cache with a newly stored reading'''
+    stale = []
+    with _latest_lock:
+        for c in ROLLUP_COLUMNS:
+            value = getattr(reading, c)
+            ts, _ = _latest[c]
+            if value is not None and (ts is None or reading.ts >= ts):
+                _latest[c] = (reading.ts, value)
+            elif value is None and ts == reading.ts:
+                stale.append(c)
+    if any(stale):
+        _reload_latest(stale)
+
+
+def _invalidate_latest(after, before):
+    '''Reloads cached latest values which changes to readings in
+    [after, before] may have made stale: those taken from readings in it,
+    and those older than it (or missing), which it may now hold newer
+    values for'''
+    with _latest_lock:
+        stale = [c for c in ROLLUP_COLUMNS
+                 if _latest[c][0] is None or _latest[c][0] <= before]
+    if any(stale):
+        _reload_latest(stale)
+
+
+def _reload_latest(columns):
+    loaded = _load_latest(columns)
+    with _latest_lock:
+        _latest.update(loaded)
 
 
 def add_reading(json_reading):
     '''Convert JSON into a reading object'''
     r = Reading(**json_reading)
     db.session.add(r)
+    _refresh_rollups(r.ts, r.ts)
+    _stamp_change(r.ts, r.ts)
     db.session.commit()
+    _catch_up()
     return r
 
 
+# readings waiting to be stored by flush_readings; see buffer_readings
+_pending = []
+_pending_since = None
+_pending_lock = threading.Lock()
+
+
+def _stored_ts(timestamps):
+    '''Returns those of timestamps which readings are stored at'''
+    timestamps = list(timestamps)
+    stored = set()
+    # in chunks, as SQLite limits the parameters of a statement
+    for i in range(0, len(timestamps), 500):
+        stored.update(ts for ts, in db.session.query(Reading.ts)
+                      .filter(Reading.ts.in_(timestamps[i:i + 500])))
+    return stored
+
+
+def buffer_readings(json_readings):
+    '''Queues readings to be stored together in a single transaction.
+    The readings are validated (and, if they have no ts, timestamped)
+    immediately, but are only written once POOL_INGEST_BATCH_SIZE are
+    waiting, once the oldest has waited POOL_INGEST_MAX_AGE seconds, or
+    when flush_readings is called.
+    Raises DalException, queueing none of them, if any has the ts of a
+    stored or buffered reading, or of another of them. They are published
+    to hub once queued, rather than once stored, so streams get them live.
+    '''
+    global _pending_since
+    readings = [Reading(**r) for r in json_readings]
+    timestamps = set()
+    clashes = set()
+    for r in readings:
+        if r.ts in timestamps:
+            clashes.add(r.ts)
+        timestamps.add(r.ts)
+    clashes.update(_stored_ts(timestamps))
+    with _pending_lock:
+        clashes.update(r.ts for r in _pending if r.ts in timestamps)
+        if any(clashes):
+            raise DalException('there are already readings at: ' +
+                               ', '.join(str(ts) for ts in sorted(clashes)))
+        if _pending_since is None:
+            _pending_since = time.time()
+        _pending.extend(readings)
+        _published_pending.update(timestamps)
+        full = len(_pending) >= app.config['POOL_INGEST_BATCH_SIZE']
+        old = time.time() - _pending_since >= app.config['POOL_INGEST_MAX_AGE']
+    for r in readings:
+        hub.publish(('reading', as_dict(r)))
+    if full or old:
+        flush_readings()
+
+
+def _hour_spans(timestamps):
+    '''Returns the (first, last) of the given ts in each run of
+    consecutive hours they fall in, oldest first'''
+    spans = []
+    for ts in sorted(timestamps):
+        hour = ts - ts % HOUR_MS
+        if any(spans) and spans[-1][1] - spans[-1][1] % HOUR_MS >= hour - HOUR_MS:
+            spans[-1] = (spans[-1][0], ts)
+        else:
+            spans.append((ts, ts))
+    return spans
+
+
+def _requeue(readings, since):
+    '''Puts readings taken from the buffer at since back at its front'''
+    global _pending_since
+    with _pending_lock:
+        _pending[:0] = readings
+        if _pending_since is None or since < _pending_since:
+            _pending_since = since
+
+
+def flush_readings():
+    '''Stores all buffered readings in one transaction.
+    If that fails because some clash with stored readings, the rest are
+    stored one at a time. If it fails for any other reason (such as the
+    database being locked), the readings not yet stored are put back in
+    the buffer and the error raised. Returns the number of readings stored.
+    '''
+    global _pending_since
+    with _pending_lock:
+        batch = _pending[:]
+        since = _pending_since
+        del _pending[:]
+        _pending_since = None
+    if not any(batch):
+        return 0
+
+    insert = Reading.__table__.insert()
+    try:
+        db.session.execute(insert, [as_dict(r) for r in batch])
+        # a batch may hold readings far apart, such as a late upload with
+        # current ones, so only the hours it has readings in are refreshed
+        for after, before in _hour_spans(r.ts for r in batch):
+            _refresh_rollups(after, before)
+            _stamp_change(after, before)
+        db.session.commit()
+        stored = batch
+    except IntegrityError:
+        db.session.rollback()
+        stored = []
+        for i, r in enumerate(batch):
+            try:
+                db.session.execute(insert, as_dict(r))
+                _refresh_rollups(r.ts, r.ts)
+                _stamp_change(r.ts, r.ts)
+                db.session.commit()
+                stored.append(r)
+            except IntegrityError:
+                db.session.rollback()
+                _published_pending.discard(r.ts)
+                print('Dropped buffered reading at {}: already stored'
+                      .format(r.ts))
+            except Exception:
+                db.session.rollback()
+                _requeue(batch[i:], since)
+                raise
+    except Exception:
+        db.session.rollback()
+        _requeue(batch, since)
+        raise
+
+    _catch_up()
+    _published_pending.difference_update(r.ts for r in stored)
+    return len(stored)
+
+
 def update_reading(json_reading):
     updated = Reading(**json_reading)
     current = get_reading_at(updated.ts)
@@ -263,16 +882,188 @@ def update_reading(json_reading):
     for d in Reading.definitions:
         setattr(current, d[0], getattr(updated, d[0]))
     db.session.add(current)
+    _refresh_rollups(current.ts, current.ts)
+    _stamp_change(current.ts, current.ts)
     db.session.commit()
+    _catch_up()
 
 
 def _get_readings_query(after, before):
     return Reading.query.filter(Reading.ts >= after, Reading.ts <= before)
 
 
-def get_readings(after, before):
-    return _get_readings_query(after, before)\
-        .order_by(desc(Reading.ts))\
+def get_readings(after, before, limit=None, with_events=False):
+    '''Returns readings in [after, before], newest first; at most limit
+    of them if given. If with_events, the events of all the readings are
+    loaded up front in one more query, rather than one query per reading
+    when each reading's events are first used.
+    '''
+    query = _get_readings_query(after, before).order_by(desc(Reading.ts))
+    if with_events:
+        query = query.options(selectinload(Reading.events))
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all()
+
+
+def get_readings_page(after, before, limit, with_events=False):
+    '''Returns (readings, more): the newest limit readings in
+    [after, before], and whether there are older ones in that window.
+    The next page is those before the last reading returned.'''
+    readings = get_readings(after, before, limit + 1, with_events)
+    return readings[:limit], len(readings) > limit
+
+
+def iter_reading_rows(after, before, columns, limit=None, batch_size=1000):
+    '''Iterates over the readings in [after, before], newest first, as
+    plain tuples of the given columns; at most limit of them if given.
+    Rows are loaded batch_size at a time as they are iterated over, and
+    skip building Reading objects entirely, so this is much cheaper than
+    get_readings for serializing many readings (see utils.serializers).
+    '''
+    query = db.session.query(*[getattr(Reading, c) for c in columns])\
+        .filter(Reading.ts >= after, Reading.ts <= before)\
+        .order_by(desc(Reading.ts))
+    if limit is not None:
+        query = query.limit(limit)
+    return query.yield_per(batch_size)
+
+
+def get_reading_rows_page(after, before, limit, columns):
+    '''As get_readings_page, but returns readings as tuples of columns
+    like iter_reading_rows. columns must include ts.'''
+    rows = list(iter_reading_rows(after, before, columns, limit + 1))
+    return rows[:limit], len(rows) > limit
+
+
+# NumPy dtypes of reading columns returned by get_readings_columns:
+# int64 ms timestamps, and float32 for every measurement
+COLUMN_DTYPES = {d[0]: np.int64 if d[0] == 'ts' else np.float32
+                 for d in Reading.definitions}
+
+
+def get_readings_columns(after, before, columns, batch_size=5000):
+    '''Returns the readings in [after, before], oldest first, as typed
+    columns: {column: (values, mask)}, where values is a NumPy array of
+    the column's COLUMN_DTYPES type, with nulls stored as NaN, and mask
+    is a bool array which is True where the value is not null.
+    Rows are read and converted batch_size at a time, so only the arrays
+    grow with the window.
+    '''
+    rows = iter(db.session.query(*[getattr(Reading, c) for c in columns])
+                .filter(Reading.ts >= after, Reading.ts <= before)
+                .order_by(Reading.ts)
+                .yield_per(batch_size))
+    chunks = {c: [np.empty(0, dtype=COLUMN_DTYPES[c])] for c in columns}
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not any(batch):
+            break
+        for c, raw in zip(columns, zip(*batch)):
+            # NumPy reads None as NaN in float arrays; ts is never null
+            chunks[c].append(np.array(raw, dtype=COLUMN_DTYPES[c]))
+    result = {}
+    for c in columns:
+        values = np.concatenate(chunks[c])
+        if c == 'ts':
+            mask = np.ones(len(values), dtype=bool)
+        else:
+            mask = ~np.isnan(values)
+        result[c] = values, mask
+    return result
+
+
+def _compacted_before(rollup):
+    '''Returns the ts before which a rollup table (or raw readings, for
+    None) may be missing readings, having been compacted'''
+    if rollup is None:
+        return _settings['raw_compacted_before']
+    if rollup is reading_hourly:
+        return _settings['hourly_compacted_before']
+    return 0
+
+
+def _get_bounds(after, before):
+    '''Returns the ts of the first and last readings in [after, before],
+    or (None, None) if there are none. Rollup buckets stand in for raw
+    readings where those may have been compacted.'''
+    columns = [Reading.ts]
+    if after < _settings['raw_compacted_before']:
+        columns += [table.c.bucket for table, _ in ROLLUPS]
+    firsts = [db.session.query(func.min(ts)).filter(ts >= after, ts <= before).scalar()
+              for ts in columns]
+    lasts = [db.session.query(func.max(ts)).filter(ts >= after, ts <= before).scalar()
+             for ts in columns]
+    firsts = [ts for ts in firsts if ts is not None]
+    lasts = [ts for ts in lasts if ts is not None]
+    if not firsts:
+        return None, None
+    return min(firsts), max(lasts)
+
+
+def get_readings_bucketed(after, before, columns, bucket_ms=None, max_points=None):
+    '''Aggregates readings in [after, before] into fixed-width time buckets.
+    bucket_ms (the bucket width), max_points (the most buckets to
+    return) or both must be given; given both, buckets are widened from
+    bucket_ms as needed to return at most max_points. Each returned
+    row has ts (the first reading in the bucket), count, and for every
+    requested column its mean under the column's name plus <name>_min
+    and <name>_max.
+    Wide buckets are computed from the coarsest rollup table that is no
+    wider than a bucket rather than from the raw readings. Windows
+    reaching back to compacted readings (see compact_readings) are
+    computed from the finest rollup which still holds them.
+    '''
+    first, last = _get_bounds(after, before)
+    if first is None:
+        return []
+    fit = max_points is not None
+    if fit:
+        bucket_ms = max(bucket_ms or 1, -(-(last - first + 1) // max_points))
+
+    # read from the coarsest level no wider than a bucket, unless readings
+    # as old as first were compacted away; then from the finest that has them
+    levels = [(None, 1)] + ROLLUPS
+    kept = [l for l in levels if _compacted_before(l[0]) <= first]
+    narrow = [l for l in kept if l[1] <= bucket_ms]
+    rollup = narrow[-1] if any(narrow) else kept[0]
+    if rollup[0] is None:
+        rollup = None
+    elif fit:
+        # buckets start at the rollup bucket holding first, so must
+        # be widened to fit max_points over the longer span
+        width = rollup[1]
+        bucket_ms = max(bucket_ms,
+                        -(-(last - first + first % width + 1) // max_points))
+
+    if rollup is None:
+        ts = Reading.ts
+        start = first
+        aggregates = [func.min(ts).label('ts'),
+                      func.count(ts).label('count')]
+        for name in columns:
+            col = getattr(Reading, name)
+            aggregates += [func.avg(col).label(name),
+                           func.min(col).label(name + '_min'),
+                           func.max(col).label(name + '_max')]
+    else:
+        table, width = rollup
+        ts = table.c.bucket
+        start = first - first % width
+        aggregates = [func.min(ts).label('ts'),
+                      func.sum(table.c.count).label('count')]
+        for name in columns:
+            mean = func.sum(table.c[name + '_sum']) / \
+                func.sum(table.c[name + '_count'])
+            aggregates += [mean.label(name),
+                           func.min(table.c[name + '_min']).label(name + '_min'),
+                           func.max(table.c[name + '_max']).label(name + '_max')]
+
+    bucket = cast((ts - start) / bucket_ms, db.Integer)
+    return db.session.query(*aggregates)\
+        .filter(ts >= start, ts <= before)\
+        .group_by(bucket)\
+        .order_by(desc('ts'))\
         .all()
 
 
@@ -280,6 +1071,33 @@ def get_reading_at(reading_ms):
     return Reading.query.filter(Reading.ts == reading_ms).first()
 
 
+def get_latest_values():
+    '''Returns the most recent value of every reading column as
+    {column: (ts, value)}, with (None, None) for columns never read.
+    This is served from memory, without querying the database.
+    '''
+    with _latest_lock:
+        return dict(_latest)
+
+
+def get_measurements(after, before, column):
+    '''Returns (ts, value) for each reading in [after, before] with a
+    value for column, oldest first. This only reads those readings, so
+    is cheap for sparse columns (see SPARSE_COLUMNS).'''
+    col = getattr(Reading, column)
+    return db.session.query(Reading.ts, col)\
+        .filter(col != None, Reading.ts >= after, Reading.ts <= before)\
+        .order_by(Reading.ts)\
+        .all()
+
+
+def get_values_before(ts, columns):
+    '''Returns the most recent value of each column from readings
+    before ts, as {column: (ts, value)}, with (None, None) for columns
+    with none'''
+    return _load_latest(columns, before=ts)
+
+
 def get_most_recent(reading_type):
     col = getattr(Reading, reading_type)
     return Reading.query\
@@ -291,7 +1109,10 @@ def get_most_recent(reading_type):
 def add_event(reading, json_event):
     e = Event(reading, **json_event)
     db.session.add(e)
+    db.session.flush()
+    _stamp_change(reading.ts, reading.ts, e.event_id)
     db.session.commit()
+    _catch_up()
     return e
 
 
@@ -303,7 +1124,40 @@ def add_event_by_time(reading_time, json_event):
 
 
 def get_events(after, before):
-    return Event.query.filter(Event.reading_ts >= after, Event.reading_ts <= before).all()
+    return Event.query.filter(Event.reading_ts >= after, Event.reading_ts <= before)\
+        .order_by(Event.reading_ts)\
+        .all()
+
+
+def get_event_summary(after, before):
+    '''Aggregates the events in [after, before] by type, in one query.
+    Returns a row per type with any events, holding event_type, count,
+    total, mean, min and max of their quantities (counting events without
+    a quantity as 1), and the ts of the first and last.'''
+    quantity = func.coalesce(Event.quantity, 1)
+    return db.session.query(
+        Event.event_type,
+        func.count(Event.event_id).label('count'),
+        func.sum(quantity).label('total'),
+        func.avg(quantity).label('mean'),
+        func.min(quantity).label('min'),
+        func.max(quantity).label('max'),
+        func.min(Event.reading_ts).label('first'),
+        func.max(Event.reading_ts).label('last'),
+    ).filter(Event.reading_ts >= after, Event.reading_ts <= before)\
+        .group_by(Event.event_type)\
+        .all()
+
+
+def get_event_comments(after, before, limit):
+    '''Returns the newest limit events in [after, before] with comments,
+    as rows of event_type, reading_ts and comment, newest first'''
+    return db.session.query(Event.event_type, Event.reading_ts, Event.comment)\
+        .filter(Event.reading_ts >= after, Event.reading_ts <= before,
+                Event.comment != None, Event.comment != '')\
+        .order_by(desc(Event.reading_ts))\
+        .limit(limit)\
+        .all()
 
 
 def get_events_at(reading_ms):
@@ -317,38 +1171,156 @@ def get_events_by_kind(after, before, kind):
 
 
 def delete_readings(after, before):
-    deleted = _get_readings.query(after, before).delete()
+    deleted = _get_readings_query(after, before).delete()
+    _refresh_rollups(after, before)
+    _stamp_change(after, before)
     db.session.commit()
+    _catch_up()
     return deleted
 
 
 def delete_event_by_id(event_id):
-    deleted = Event.query.filter(Event.event_id == event_id).delete()
+    e = Event.query.get(event_id)
+    if e is None:
+        return False
+    db.session.delete(e)
+    _stamp_change(e.reading_ts, e.reading_ts)
     db.session.commit()
-    return deleted >= 1
+    _catch_up()
+    return True
 
 
 def delete_reading_at(reading_ts):
     deleted = Reading.query.filter(Reading.ts == reading_ts).delete()
+    _refresh_rollups(reading_ts, reading_ts)
+    _stamp_change(reading_ts, reading_ts)
     db.session.commit()
+    _catch_up()
     return deleted >= 1
 
 
+def _retention_cutoff(setting, now):
+    '''Returns the start of the day (ms since epoch) before which a
+    retention setting expires readings, or None if it keeps them for ever'''
+    days = _settings[setting]
+    if days <= 0:
+        return None
+    cutoff = int(1000 * now) - days * DAY_MS
+    return cutoff - cutoff % DAY_MS
+
+
+def compact_readings(now=None, batch_size=None):
+    '''Applies the retention settings: raw readings older than
+    raw_retention_days are deleted, leaving their hourly and daily
+    rollups, then hourly and daily rollups older than their own
+    retention are deleted, and the freed pages returned to the
+    filesystem. Readings with events or manual measurements (any of
+    SPARSE_COLUMNS), and those holding the latest value of a column, are
+    kept. Readings are deleted batch_size at a time
+    (default POOL_COMPACTION_BATCH_SIZE), a transaction per batch.
+    Returns the number of readings deleted.
+    '''
+    now = now or time.time()
+    batch_size = batch_size or app.config['POOL_COMPACTION_BATCH_SIZE']
+
+    raw_before = _retention_cutoff('raw_retention_days', now)
+    if raw_before is not None and raw_before > _settings['raw_compacted_before']:
+        # recorded first, so rollups of these days are never recomputed
+        # from what is left of them
+        update_setting('raw_compacted_before', raw_before)
+
+    with _latest_lock:
+        latest = {ts for ts, _ in _latest.values() if ts is not None}
+    has_events = db.session.query(Event.reading_ts)\
+        .filter(Event.reading_ts == Reading.ts).exists()
+    # manual measurements are few, and cannot be taken again
+    measured = [getattr(Reading, c) != None for c in SPARSE_COLUMNS]
+    expired = Reading.query.filter(Reading.ts < _settings['raw_compacted_before'],
+                                   ~has_events, ~or_(*measured))
+    if latest:
+        expired = expired.filter(~Reading.ts.in_(latest))
+    deleted = 0
+    first = 0
+    while True:
+        in_batch = expired.filter(Reading.ts >= first)\
+            .order_by(Reading.ts)\
+            .with_entities(Reading.ts)
+        last = in_batch.offset(batch_size - 1).limit(1).scalar()
+        if last is None:
+            last = _settings['raw_compacted_before']
+        count = expired.filter(Reading.ts >= first, Reading.ts <= last)\
+            .delete(synchronize_session=False)
+        db.session.commit()
+        deleted += count
+        if count < batch_size:
+            break
+        first = last + 1
+
+    # hourly rollups are kept while the days they make up could still be
+    # recomputed from raw readings
+    hourly_before = _retention_cutoff('hourly_retention_days', now)
+    if hourly_before is not None:
+        hourly_before = min(hourly_before, _settings['raw_compacted_before'])
+        if hourly_before > _settings['hourly_compacted_before']:
+            update_setting('hourly_compacted_before', hourly_before)
+            db.session.execute(reading_hourly.delete()
+                               .where(reading_hourly.c.bucket < hourly_before))
+    daily_before = _retention_cutoff('daily_retention_days', now)
+    if daily_before is not None:
+        db.session.execute(reading_daily.delete()
+                           .where(reading_daily.c.bucket < daily_before))
+    if deleted:
+        _stamp_change(0, _settings['raw_compacted_before'])
+    db.session.commit()
+
+    # sqlite3's execute only steps this once, freeing a single page,
+    # while executescript runs it to completion
+    db.session.connection().connection.executescript('PRAGMA incremental_vacuum')
+    if deleted:
+        _catch_up()
+        print('Compacted {} readings from before {}'
+              .format(deleted, _settings['raw_compacted_before']))
+    return deleted
+
+
 def get_settings():
     return _settings
 
 
+@app.before_request
+def refresh_settings():
+    '''Reloads settings if any process has changed them since they were
+    last loaded, and catches up with changes other processes have made
+    to readings and events (see _catch_up). This costs a single query
+    when nothing has changed, so it is done before every request (and
+    scheduled job).'''
+    settings_version = Setting.query.with_entities(Setting.value)\
+        .filter_by(name='settings_version').as_scalar()
+    data_version = db.session.query(func.max(DataChange.version)).as_scalar()
+    settings_version, data_version = \
+        db.session.query(settings_version, data_version).one()
+    if int(settings_version) != _settings['settings_version']:
+        _load_settings()
+    if data_version is not None and data_version > _data_stamp[0]:
+        _catch_up()
+
+
 def get_setting_value(key):
     return Setting.query.filter_by(name=key).first().get_value()
 
 
 def update_setting(key, value, delay_commit=False):
-    if key == 'database_version':
+    if key in ('database_version', 'settings_version'):
         raise Exception(
-            'Database version should not be changed programmatically')
+            '{} should not be changed programmatically'.format(key))
     converted = SETTINGS_TYPES[key][0](value)
     _settings[key] = converted
     Setting.query.filter_by(name=key).update({Setting.value: str(converted)})
+    # bumped in the database, so concurrent updates from several
+    # processes each count
+    Setting.query.filter_by(name='settings_version').update(
+        {Setting.value: cast(cast(Setting.value, db.Integer) + 1, db.String)},
+        synchronize_session=False)
     if not delay_commit:
         db.session.commit()
 
@@ -0,0 +1,355 @@
+'''
+Benchmarks for the data access layer.
+Run from the repository root with:
+    python -m pool.backend.dal_bench [concurrency|serialization|hotpaths]
+
+concurrency: read/write concurrency under each of dal.STORAGE_PROFILES,
+    on temporary databases. A writer stores one reading per transaction,
+    as add_reading does, while readers repeatedly scan the whole table,
+    as a CSV export does.
+serialization: readings serialized per second as JSON and CSV, through
+    ORM objects (get_readings) and through plain rows (iter_reading_rows
+    and utils.serializers). This only reads the newest readings of the
+    configured database.
+hotpaths: the app's hot paths, timed --repeat times each through the
+    Flask test client where they are served over HTTP, on --years of
+    synthetic readings (one every --interval seconds, from the simulated
+    sensors in pool.sensors) with the manual tests and events a pool
+    owner would record. These are generated into a temporary database
+    unless POOL_DATABASE_URI is set. --output writes a JSON report which
+    can be compared across commits.
+'''
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# the database is set up when dal is imported, so this has to come first
+if __name__ == '__main__' and sys.argv[1:2] == ['hotpaths']:
+    os.environ.setdefault('POOL_DATABASE_URI', 'sqlite:///' +
+                          os.path.join(tempfile.mkdtemp(), 'bench.db'))
+
+from sqlalchemy.schema import CreateTable
+
+from pool import app, sensors
+from pool.backend import dal
+from pool.utils import serializers
+import pool.schedule as schedule
+
+SEED_READINGS = 200000
+READERS = 2
+DURATION = 5  # s
+SERIALIZED_READINGS = 100000
+SEED = 1
+DAY = 24 * 60 * 60  # s
+# readings generated per transaction
+GENERATE_BATCH_SIZE = 10000
+
+
+def _connect(path, profile):
+    con = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    dal.apply_storage_profile(con, profile)
+    return con
+
+
+def _seed(con):
+    ddl = str(CreateTable(dal.Reading.__table__).compile(dal.db.engine))
+    con.execute(ddl)
+    con.executemany('INSERT INTO reading (ts, ph, pool_temp) VALUES (?, ?, ?)',
+                    ((ts, 7.5, 25.0) for ts in range(SEED_READINGS)))
+    con.commit()
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run_profile(profile):
+    '''Returns the writes/s, write latencies and scans/s under a profile'''
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    _seed(_connect(path, profile))
+
+    stop = threading.Event()
+    latencies = []
+    scans = []
+
+    def write():
+        con = _connect(path, profile)
+        ts = SEED_READINGS
+        while not stop.is_set():
+            start = time.time()
+            con.execute('INSERT INTO reading (ts, ph) VALUES (?, ?)', (ts, 7.5))
+            con.commit()
+            latencies.append(time.time() - start)
+            ts += 1
+
+    def read():
+        con = _connect(path, profile)
+        while not stop.is_set():
+            con.execute('SELECT * FROM reading ORDER BY ts DESC').fetchall()
+            scans.append(1)
+
+    threads = [threading.Thread(target=write)] + \
+        [threading.Thread(target=read) for _ in range(READERS)]
+    for t in threads:
+        t.start()
+    time.sleep(DURATION)
+    stop.set()
+    for t in threads:
+        t.join()
+
+    return {
+        'writes/s': len(latencies) / DURATION,
+        'write p50 (ms)': 1000 * _percentile(latencies, 0.5),
+        'write max (ms)': 1000 * max(latencies),
+        'scans/s': len(scans) / DURATION,
+    }
+
+
+def run_serialization():
+    '''Returns the readings/s of each way of serializing readings'''
+    columns = [d[0] for d in dal.Reading.definitions]
+    before = int(1000 * time.time())
+    newest, _ = dal.get_reading_rows_page(0, before, SERIALIZED_READINGS, ['ts'])
+    if not any(newest):
+        return {}
+    after = newest[-1].ts
+
+    def orm_json():
+        return [dal.as_dict(r) for r in dal.get_readings(after, before)]
+
+    def orm_csv():
+        return [str(r) + '\n' for r in dal.get_readings(after, before)]
+
+    def rows_json():
+        write = serializers.json_writer(columns)
+        return [write(r) for r in dal.iter_reading_rows(after, before, columns)]
+
+    def rows_csv():
+        write = serializers.csv_writer(columns)
+        return [write(r) for r in dal.iter_reading_rows(after, before, columns)]
+
+    results = {}
+    for name, serialize in [('orm json', orm_json), ('rows json', rows_json),
+                            ('orm csv', orm_csv), ('rows csv', rows_csv)]:
+        start = time.time()
+        count = len(serialize())
+        results[name] = count / (time.time() - start)
+    return results
+
+
+def _commit():
+    '''Returns the git commit of the working tree, if there is one'''
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _sensor_reading(ts):
+    '''Reads every simulated sensor. The simulated pH probe climbs 0.1
+    with every read, so pH is drawn around a typical value instead.'''
+    reading = {m: s.read() for m, s in sensors.SENSORS.items() if m != 'ph'}
+    reading['ph'] = round(random.gauss(7.5, 0.1), 2)
+    reading['ts'] = ts
+    return reading
+
+
+def generate(years, interval):
+    '''Stores years of readings ending now, one every interval seconds,
+    with a manual test every day and chlorine added every three days.
+    Returns the number of readings and events stored.
+    '''
+    random.seed(SEED)
+    end = int(time.time())
+    start = end - int(years * 365 * DAY)
+    events = []
+    batch = []
+    fc = 5.0
+    next_test = start
+    for t in range(start, end, interval):
+        reading = _sensor_reading(1000 * t)
+        fc *= 0.75 ** (interval / DAY)
+        if t >= next_test:
+            day = (t - start) // DAY
+            next_test += DAY
+            reading.update(fc=round(fc, 1), tc=round(fc + random.random(), 1))
+            if day % 7 == 0:
+                reading.update(ta=random.randint(80, 120),
+                               ca=random.randint(200, 400),
+                               cya=random.randint(30, 50))
+            if day % 3 == 0:
+                fc += 3.0
+                events.append((reading['ts'], {
+                    'event_type': 'ADD-CL',
+                    'quantity': 0.5,
+                    'comment': 'weekly shock' if day % 21 == 0 else None,
+                }))
+            if day % 30 == 0:
+                events.append((reading['ts'], {'event_type': 'BACKWASH'}))
+            if random.random() < 0.3:
+                events.append((reading['ts'], {
+                    'event_type': 'SWIM',
+                    'quantity': random.randint(1, 6),
+                }))
+            if random.random() < 0.05:
+                events.append((reading['ts'], {
+                    'event_type': 'WEATHER',
+                    'comment': 'storm',
+                }))
+        batch.append(reading)
+        if len(batch) == GENERATE_BATCH_SIZE:
+            dal.buffer_readings(batch)
+            dal.flush_readings()
+            batch = []
+    dal.buffer_readings(batch)
+    dal.flush_readings()
+    for ts, event in events:
+        dal.add_event_by_time(ts, event)
+    count = dal.db.session.query(dal.func.count(dal.Reading.ts)).scalar()
+    return count, len(events)
+
+
+def hot_paths():
+    '''Returns the hot paths to time, as (name, run)'''
+    client = app.test_client()
+    first = dal.db.session.query(dal.func.min(dal.Reading.ts)).scalar()
+    now = int(1000 * time.time())
+    week = now - 7 * DAY * 1000
+    next_ts = [now]
+
+    def get(url):
+        def run():
+            response = client.get(url)
+            assert response.status_code == 200, (url, response.status)
+            return len(response.get_data())
+        return run
+
+    def add_reading():
+        next_ts[0] += 1000
+        dal.add_reading(_sensor_reading(next_ts[0]))
+
+    def get_most_recent():
+        dal.get_most_recent('fc')
+
+    def get_readings():
+        dal.get_readings(week, now)
+
+    def post_reading():
+        next_ts[0] += 1000
+        response = client.post('/backend/readings/',
+                               json=_sensor_reading(next_ts[0]))
+        assert response.status_code == 200, response.status
+        return len(response.get_data())
+
+    return [
+        ('add_reading', add_reading),
+        ('post_reading', post_reading),
+        ('get_most_recent', get_most_recent),
+        ('get_readings', get_readings),
+        ('readings_page', get('/backend/readings/?limit=1000')),
+        ('datatable_week', get('/backend/readings/datatable?after={}'
+                               .format(week))),
+        ('datatable_all', get('/backend/readings/datatable?after={}'
+                              .format(first))),
+        ('csv_week', get('/backend/readings/csv?after={}'.format(week))),
+        ('csv_all', get('/backend/readings/csv?after={}'.format(first))),
+        ('event_summary', get('/events/list?after={}'.format(first))),
+        ('dashboard', get('/')),
+    ]
+
+
+def measure(run, repeat):
+    '''Times run() repeat times, after one untimed run to warm caches.
+    run returns the size of the response it got, in bytes, if any.
+    '''
+    size = run()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(1000 * (time.perf_counter() - start))
+    return {
+        'runs': repeat,
+        'min_ms': min(times),
+        'median_ms': _percentile(times, 0.5),
+        'p95_ms': _percentile(times, 0.95),
+        'max_ms': max(times),
+        'bytes': size,
+    }
+
+
+def run_hot_paths(years, interval, repeat):
+    '''Returns the report of the hotpaths benchmark'''
+    # the scheduler would take real readings while we measure
+    schedule.SCHEDULER.pause()
+
+    print('generating {} years of readings...'.format(years))
+    start = time.time()
+    readings, events = generate(years, interval)
+    generate_s = time.time() - start
+    print('{} readings and {} events in {:.1f} s'
+          .format(readings, events, generate_s))
+
+    results = {}
+    for name, run in hot_paths():
+        results[name] = measure(run, repeat)
+        print('{:>16}: median {:.2f} ms'.format(name, results[name]['median_ms']))
+    return {
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'dataset': {
+            'years': years,
+            'interval': interval,
+            'readings': readings,
+            'events': events,
+            'generate_s': generate_s,
+        },
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('benchmark', nargs='?', default='concurrency',
+                        choices=['concurrency', 'serialization', 'hotpaths'])
+    parser.add_argument('--years', type=float, default=2,
+                        help='hotpaths: years of readings to generate')
+    parser.add_argument('--interval', type=int, default=300,
+                        help='hotpaths: seconds between generated readings')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='hotpaths: timed runs of each hot path')
+    parser.add_argument('--output', help='hotpaths: where to write the report')
+    args = parser.parse_args()
+
+    if args.benchmark == 'concurrency':
+        print('{} readings, {} readers, {} s per profile'
+              .format(SEED_READINGS, READERS, DURATION))
+        for profile in sorted(dal.STORAGE_PROFILES):
+            results = run_profile(profile)
+            print('{:>8}: '.format(profile) +
+                  ', '.join('{} {:.1f}'.format(k, v) for k, v in results.items()))
+    elif args.benchmark == 'serialization':
+        print('newest {} readings'.format(SERIALIZED_READINGS))
+        for name, rate in run_serialization().items():
+            print('{:>10}: {:.0f} readings/s'.format(name, rate))
+    else:
+        report = run_hot_paths(args.years, args.interval, args.repeat)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
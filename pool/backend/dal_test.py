@@ -1,8 +1,13 @@
-import dal
+import datetime
+import os
+import tempfile
 import time
+from sqlalchemy import event
 
-dal.Reading.query.filter().delete()
-dal.Event.query.filter().delete()
+# run against a scratch database rather than whichever pool.db is around
+os.environ['POOL_DATABASE_URI'] = 'sqlite:///' + \
+    os.path.join(tempfile.mkdtemp(), 'test.db')
+import dal
 
 elems = [
     {
@@ -30,6 +35,30 @@ assert dal.get_most_recent('fc').fc == 10.0
 assert dal.get_most_recent('ph').ph == 7.5
 assert dal.get_most_recent('tc').tc == 0
 assert getattr(dal.get_most_recent('tc'), 'tc') == 0
+assert dal.get_latest_values()['fc'] == (2, 10.0)
+assert dal.get_latest_values()['ta'] == (3, 150)
+assert dal.get_latest_values()['cya'] == (None, None)
+columns = dal.get_readings_columns(1, 3, ['ts', 'fc'], batch_size=2)
+assert columns['ts'][0].tolist() == [1, 2, 3]
+assert columns['fc'][0][:2].tolist() == [7.5, 10.0]
+assert columns['fc'][1].tolist() == [True, True, False]
+assert dal.get_readings_columns(4, 5, ['fc'])['fc'][0].dtype == 'float32'
+
+buckets = dal.get_readings_bucketed(1, 3, ['fc', 'ph'], max_points=1)
+assert len(buckets) == 1
+assert buckets[0].count == 3
+assert buckets[0].fc_min == 7.5 and buckets[0].fc_max == 10.0
+assert len(dal.get_readings_bucketed(1, 3, ['fc'], bucket_ms=1)) == 3
+assert len(dal.get_readings_bucketed(1, 3, ['fc'], bucket_ms=1, max_points=2)) == 2
+
+
+def get_rollup(table, bucket):
+    return dal.db.session.query(table).filter(table.c.bucket == bucket).first()
+
+
+assert get_rollup(dal.reading_hourly, 0).count == 3
+assert get_rollup(dal.reading_hourly, 0).fc_max == 10.0
+assert get_rollup(dal.reading_daily, 0).ph_sum == 7.4 + 7.5
 
 dal.add_event_by_time(1, {
     'event_type': 'ADD-CL',
@@ -46,6 +75,53 @@ assert len(dal.get_events(1, 3)) == 2
 assert len(dal.get_events_at(1)) == 2
 assert len(dal.get_events_by_kind(1, 3, 'ADD-CL')) == 1
 
+
+
+def captured_sql(func, *args):
+    '''Returns the (statement, parameters) executed by func(*args)'''
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+    event.listen(dal.db.engine, 'before_cursor_execute', capture)
+    try:
+        func(*args)
+    finally:
+        event.remove(dal.db.engine, 'before_cursor_execute', capture)
+    return statements
+
+
+def query_plan(func, *args):
+    '''Returns the query plan of everything executed by func(*args)'''
+    plan = []
+    with dal.db.engine.connect() as con:
+        for statement, parameters in captured_sql(func, *args):
+            rows = con.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            plan += [row[-1] for row in rows]
+    return '\n'.join(plan)
+
+
+assert 'ix_event_reading_ts' in query_plan(dal.get_events, 1, 3)
+assert 'ix_event_reading_ts' in query_plan(dal.get_events_at, 1)
+assert 'ix_event_event_type_reading_ts' in \
+    query_plan(dal.get_events_by_kind, 1, 3, 'ADD-CL')
+assert 'ix_reading_fc_ts' in query_plan(dal.get_most_recent, 'fc')
+assert 'ix_reading_cya_ts' in query_plan(dal._load_latest, ['cya'])
+
+# migration steps can be rerun after failing part way, although SQLite
+# commits the indexes they had already created
+dal.db.session.execute('DROP INDEX ix_event_event_type_reading_ts')
+dal._migrate_to_2()
+assert 'ix_event_event_type_reading_ts' in \
+    query_plan(dal.get_events_by_kind, 1, 3, 'ADD-CL')
+
+summary = {r.event_type: r for r in dal.get_event_summary(1, 3)}
+assert summary['ADD-ACID'].total == 2.0
+assert summary['ADD-CL'].count == 1 and summary['ADD-CL'].first == 1
+assert len(captured_sql(dal.get_event_summary, 1, 3)) == 1
+assert 'ix_event_reading_ts' in query_plan(dal.get_event_summary, 1, 3)
+assert len(dal.get_event_comments(1, 3, 1)) == 1
+
 event_id = dal.get_events_at(1)[0].event_id
 assert dal.delete_event_by_id(event_id) == True
 assert dal.delete_event_by_id(event_id) == False
@@ -53,6 +129,82 @@ assert len(dal.get_events_at(1)) == 1
 assert dal.delete_reading_at(1) == True
 assert len(dal.get_events_at(1)) == 0
 assert len(dal.get_readings(1, 3)) == 2
+dal.update_reading({'ts': 3})
+assert dal.get_latest_values()['ta'] == (None, None)
+dal.delete_reading_at(2)
+assert dal.get_latest_values()['fc'] == (None, None)
+dal.add_reading({'ts': 2, 'fc': 10.0, 'ph': 7.5})
+assert dal.get_latest_values()['fc'] == (2, 10.0)
+assert get_rollup(dal.reading_hourly, 0).count == 2
+assert get_rollup(dal.reading_daily, 0).fc_min == 10.0
+
+subscriber = dal.hub.subscribe()
+dal.buffer_readings([{'ts': 4, 'fc': 1.0}, {'ts': 5, 'fc': 2.0}])
+assert dal.get_reading_at(4) is None
+# streams get buffered readings straight away, and only once
+assert [m[1]['ts'] for m in subscriber.queue] == [4, 5]
+# readings clashing with buffered or stored ones are refused outright
+for clash in [[{'ts': 5, 'fc': 3.0}], [{'ts': 6}, {'ts': 6}], [{'ts': 6}, {'ts': 3}]]:
+    try:
+        dal.buffer_readings(clash)
+        assert False, 'buffer_readings should refuse {}'.format(clash)
+    except dal.DalException:
+        pass
+assert dal.flush_readings() == 2
+assert dal.flush_readings() == 0
+assert dal.get_reading_at(5).fc == 2.0
+assert dal.get_latest_values()['fc'] == (5, 2.0)
+
+version, modified = dal.get_data_version()
+assert dal.get_data_version() == (version, modified)
+dal.add_event_by_time(2, {'event_type': 'SWIM', 'quantity': 3})
+assert dal.get_data_version()[0] != version
+version, _ = dal.get_data_version()
+dal.add_event_by_time(4, {'event_type': 'BACKWASH'})
+assert dal.get_data_version()[0] != version
+assert [m[0] for m in subscriber.queue] == ['reading', 'reading', 'event', 'event']
+assert subscriber.get()[1]['ts'] == 4
+# edits are not new readings, so streams are not sent them
+subscriber.queue.clear()
+dal.update_reading({'ts': 5, 'fc': 2.0})
+assert subscriber.empty()
+dal.hub.unsubscribe(subscriber)
+
+
+def load_events(with_events):
+    return [r.get_events_str() for r in
+            dal.get_readings(1, 5, with_events=with_events)]
+
+
+num_readings = len(dal.get_readings(1, 5))
+dal.db.session.expire_all()
+assert len(captured_sql(load_events, False)) == 1 + num_readings
+dal.db.session.expire_all()
+assert len(captured_sql(load_events, True)) == 2
+assert load_events(True) == load_events(False)
+
+changes = []
+listener = dal.on_change(lambda after, before: changes.append((after, before)))
+for ts in [6, 7, 8]:
+    dal.add_reading({'ts': ts, 'tc': 1.0})
+assert changes == [(6, 6), (7, 7), (8, 8)]
+assert dal.get_measurements(0, 7, 'tc') == [(6, 1.0), (7, 1.0)]
+dal._change_listeners.remove(listener)
+hourly_count = get_rollup(dal.reading_hourly, 0).count
+# readings are kept for ever unless retention is set
+assert dal.compact_readings(now=2 * 24 * 60 * 60) == 0
+dal.update_setting('raw_retention_days', 1)
+# a day later, only readings without events (as 2 and 4 have) or manual
+# measurements (as the rest but 3 have) are compacted
+assert dal.compact_readings(now=2 * 24 * 60 * 60, batch_size=1) == 1
+assert [r.ts for r in dal.get_readings(0, 10)] == [8, 7, 6, 5, 4, 2]
+assert get_rollup(dal.reading_hourly, 0).count == hourly_count
+dal.add_event_by_time(8, {'event_type': 'SWIM'})
+dal.delete_reading_at(8)
+assert get_rollup(dal.reading_hourly, 0).count == hourly_count
+assert dal.get_readings_bucketed(0, 10, ['tc'], max_points=10)[0].count == hourly_count
+dal.update_setting('raw_retention_days', 0)
+dal.update_setting('raw_compacted_before', 0)
 
 
 dal.update_setting('reading_interval', 30)
@@ -60,6 +212,63 @@ assert dal.get_setting_value('reading_interval') == 30
 dal.update_setting('reading_interval', 60)
 assert dal.get_setting_value('reading_interval') == 60
 
+# settings changed by another process are reloaded by refresh_settings,
+# which only costs one query when they have not changed
+dal.refresh_settings()
+assert len(captured_sql(dal.refresh_settings)) == 1
+dal.update_setting('reading_interval', 45)
+dal.get_settings()['reading_interval'] = 60
+dal.refresh_settings()
+assert dal.get_settings()['reading_interval'] == 45
+dal.update_setting('reading_interval', 60)
+
+# as are readings stored by another process
+subscriber = dal.hub.subscribe()
+with dal.db.engine.connect() as con:
+    con.execute('INSERT INTO reading (ts, fc) VALUES (9, 9.9)')
+    con.execute('INSERT INTO data_change (after, before, at) VALUES (9, 9, 0)')
+version, _ = dal.get_data_version()
+dal.refresh_settings()
+assert dal.get_data_version()[0] != version
+assert dal.get_latest_values()['fc'] == (9, 9.9)
+assert subscriber.get_nowait()[1]['ts'] == 9
+dal.hub.unsubscribe(subscriber)
+dal.delete_reading_at(9)
+
+
+def lock_readings(conn, cursor, statement, parameters, context, executemany):
+    if statement.startswith('INSERT INTO reading '):
+        raise RuntimeError('database is locked')
+
+
+# a batch which fails for any reason but a clash stays buffered
+dal.buffer_readings([{'ts': 10, 'ph': 7.0}, {'ts': 11, 'ph': 7.1}])
+event.listen(dal.db.engine, 'before_cursor_execute', lock_readings)
+try:
+    dal.flush_readings()
+    assert False, 'flush_readings should fail'
+except RuntimeError:
+    pass
+finally:
+    event.remove(dal.db.engine, 'before_cursor_execute', lock_readings)
+assert dal.flush_readings() == 2
+assert dal.get_reading_at(11).ph == 7.1
+dal.delete_readings(10, 11)
+
+# a batch only refreshes the hours it has readings in
+changes = []
+listener = dal.on_change(lambda after, before: changes.append((after, before)))
+dal.buffer_readings([{'ts': 10, 'ph': 7.0}, {'ts': 3 * dal.DAY_MS, 'ph': 7.2},
+                     {'ts': 11, 'ph': 7.1}])
+statements = captured_sql(dal.flush_readings)
+assert changes == [(10, 11), (3 * dal.DAY_MS, 3 * dal.DAY_MS)]
+assert len([s for s, _ in statements if s.startswith('DELETE FROM reading_hourly')]) == 2
+dal._change_listeners.remove(listener)
+dal.delete_readings(10, 3 * dal.DAY_MS)
+# consecutive hours are refreshed together
+assert dal._hour_spans([dal.HOUR_MS + 5, 3 * dal.DAY_MS, 10]) == \
+    [(10, dal.HOUR_MS + 5), (3 * dal.DAY_MS, 3 * dal.DAY_MS)]
+
 
 dal.update_setting('compensation_temp', 25)
 dal.update_setting('compensation_delta', 1)
@@ -72,3 +281,176 @@ dal.update_setting('compensation_delta', 5)
 assert dal.should_compensate(22) == False
 dal.update_setting('compensation_temp', 25)
 dal.update_setting('compensation_delta', 1)
+
+# buckets read from rollups start on the hour, yet still fit max_points
+for ts in [3 * dal.HOUR_MS - 1000, 4 * dal.HOUR_MS, 5 * dal.HOUR_MS]:
+    dal.add_reading({'ts': ts, 'ph': 7.0})
+after = 3 * dal.HOUR_MS - 1000
+assert len(dal.get_readings_bucketed(after, 5 * dal.HOUR_MS, ['ph'], max_points=2)) == 2
+dal.delete_readings(after, 5 * dal.HOUR_MS)
+
+# queries are only timed once POOL_METRICS is set
+from pool.utils import instrumentation
+dal.get_most_recent('fc')
+assert 'pool_sql_query_seconds_count' not in instrumentation.render()
+dal.app.config['POOL_METRICS'] = True
+dal.get_most_recent('fc')
+dal.app.config['POOL_METRICS'] = False
+assert 'pool_sql_query_seconds_count' in instrumentation.render()
+
+# sensors are read at their own periods, by a single job which only runs
+# when some are due and reads those due together as one reading
+from pool import schedule
+schedule.SCHEDULER.pause()
+assert schedule.sensor_periods(60) == \
+    {'pool_temp': 60, 'ph': 300, 'air_temp': 60, 'cpu_temp': 30}
+# but never so often that they hold the bus too long
+assert schedule.sensor_periods(1)['pool_temp'] == 2
+schedule.set_reading_interval(7)
+trigger = schedule.SCHEDULER.get_job(schedule.READING_JOB_ID).trigger
+start = trigger.start
+fired = []
+when = datetime.datetime.fromtimestamp(start, datetime.timezone.utc)
+while when.timestamp() < start + 600:
+    when = trigger.get_next_fire_time(when, when)
+    fired.append(round(when.timestamp() - start))
+assert fired == sorted({t for p in [7, 30, 300] for t in range(p, 601, p)})
+assert sorted(schedule._due_sensors(start + 7)) == sorted(schedule.sensors.SENSORS)
+assert sorted(schedule._due_sensors(start + 14)) == ['air_temp', 'pool_temp']
+assert schedule._due_sensors(start + 14) == []
+assert sorted(schedule._due_sensors(start + 210)) == ['air_temp', 'cpu_temp', 'pool_temp']
+
+first = int(1000 * time.time())
+schedule.set_reading_interval(60)
+schedule._record_reading()
+schedule._record_reading()
+schedule.dal.flush_readings()
+dal.db.session.commit()
+stored = dal.get_readings(first, 2 ** 62)
+assert len(stored) == 1
+assert all(getattr(stored[0], m) is not None for m in schedule.sensors.SENSORS)
+dal.delete_readings(first, 2 ** 62)
+
+# vectorized water chemistry matches the scalar calculations
+import numpy as np
+from pool.utils import calcs, chemistry
+rows = [(7.2, 28, 300, 80), (7.6, 20, 250, 100), (7.8, 31, 400, 120)]
+ph, temp, ca, ta = (np.array(c, dtype=np.float64) for c in zip(*rows))
+for lsi, row in zip(chemistry.saturation_index(ph, temp, ca, ta), rows):
+    assert abs(lsi - calcs.saturation_index(*row)) < 1e-9
+values = np.array([np.nan, 2.0, np.nan, 4.0, np.nan])
+filled = chemistry.forward_fill(values, ~np.isnan(values))
+assert np.isnan(filled[0]) and filled[1:].tolist() == [2.0, 2.0, 4.0, 4.0]
+filled = chemistry.forward_fill(values, ~np.isnan(values), seed=1.0)
+assert filled.tolist() == [1.0, 2.0, 2.0, 4.0, 4.0]
+# readings missing a column take it from the last which had it, or the seed
+columns = {c: (np.full(3, np.nan), np.zeros(3, dtype=bool)) for c in chemistry.COLUMNS}
+for i, (row_ph, row_temp, _, row_ta) in enumerate(rows):
+    for c, value in [('ph', row_ph), ('pool_temp', row_temp), ('ta', row_ta)]:
+        columns[c][0][i], columns[c][1][i] = value, True
+columns['ca'][0][1], columns['ca'][1][1] = 250, True
+columns['fc'][0][0], columns['fc'][1][0] = 3.0, True
+columns['tc'][0][0], columns['tc'][1][0] = 3.5, True
+series = chemistry.water_chemistry(columns, {'ca': 300, 'cya': 40})
+expected = [calcs.saturation_index(7.2, 28, 300, 80),
+            calcs.saturation_index(7.6, 20, 250, 100),
+            calcs.saturation_index(7.8, 31, 250, 120)]
+assert np.allclose(series['lsi'], expected)
+assert np.allclose(series['fc_cya'], 3.0 / 40)
+assert np.allclose(series['cc'], 0.5)
+
+# chlorine decay is fitted per dose, and fits are only redone for
+# segments whose readings or events change
+import math
+from pool import chlorine
+assert chemistry.chlorine_dose(1, 10000, 10) == 0.1
+cdal = chlorine.dal
+base = 100 * dal.DAY_MS
+for hours, fc0, per_day in [(range(0, 72, 6), 8.0, 0.5), (range(72, 114, 6), 6.0, 0.25)]:
+    for h in hours:
+        fc = fc0 * math.exp(-per_day * (h - hours[0]) / 24)
+        cdal.add_reading({'ts': base + h * dal.HOUR_MS, 'fc': fc})
+    cdal.add_event_by_time(base + hours[0] * dal.HOUR_MS,
+                           {'event_type': 'ADD-CL', 'quantity': 0.5})
+segments = [s for s in chlorine.get_segments() if s['start'] >= base]
+assert [(s['start'], s['end']) for s in segments] == \
+    [(base, base + 72 * dal.HOUR_MS), (base + 72 * dal.HOUR_MS, None)]
+assert abs(segments[0]['fc0'] - 8.0) < 1e-9
+assert abs(segments[0]['decay_per_day'] - 0.5) < 1e-9
+assert abs(segments[0]['half_life_hours'] - 24 * math.log(2) / 0.5) < 1e-6
+assert abs(segments[1]['decay_per_day'] - 0.25) < 1e-9
+assert segments[0]['added'] == 0.5 and segments[0]['measurements'] == 11
+
+fitted = []
+fit_segment = chlorine._fit_segment
+chlorine._fit_segment = lambda start, end: fitted.append((start, end)) or \
+    fit_segment(start, end)
+cdal.add_reading({'ts': base + 120 * dal.HOUR_MS, 'fc': 6.0 * math.exp(-0.5)})
+segments = [s for s in chlorine.get_segments() if s['start'] >= base]
+chlorine._fit_segment = fit_segment
+assert fitted == [(base + 72 * dal.HOUR_MS, None)]
+assert segments[1]['measurements'] == 7
+assert abs(segments[1]['decay_per_day'] - 0.25) < 1e-9
+
+# a day after the second dose, fc has decayed at its rate, and the
+# demand at the target follows the same rate
+settings = cdal.get_settings()
+estimate = chlorine.get_estimate(now=(base + 96 * dal.HOUR_MS) / 1000)
+assert abs(estimate['fc_predicted'] - 6.0 * math.exp(-0.25)) < 1e-9
+demand = settings['fc_target'] * (1 - math.exp(-0.25))
+assert abs(estimate['demand_ppm_per_day'] - demand) < 1e-9
+assert abs(estimate['dose_per_day'] - chemistry.chlorine_dose(
+    demand, settings['pool_volume'], settings['chlorine_strength'])) < 1e-12
+assert abs(estimate['dose_now'] - chemistry.chlorine_dose(
+    settings['fc_target'] - estimate['fc_predicted'], settings['pool_volume'],
+    settings['chlorine_strength'])) < 1e-12
+
+# a sensor whose read hangs is not read again until that read returns,
+# so it never holds more than one of the threads sensors are read on
+import threading
+from pool import sampling, sensors
+release = threading.Event()
+slow_reads = []
+
+
+def read_slow():
+    slow_reads.append(1)
+    release.wait()
+    return 1.5
+
+
+sensors.register(sensors.Sensor('slow', read_slow, cost=0.01))
+sampling.SENSOR_TIMEOUT = 0.1
+assert sampling.take_reading(['slow']) == {}
+assert sampling.take_reading(['slow']) == {}
+assert len(slow_reads) == 1
+release.set()
+sampling._reads['slow'].result()
+assert sampling.take_reading(['slow']) == {'slow': 1.5}
+assert len(slow_reads) == 2
+
+# callers wanting the same sensors while they are being read wait for
+# that read rather than starting their own, share the sample while it is
+# fresh, and only the first to claim it stores it
+release.clear()
+sampling.SENSOR_TIMEOUT = 5
+sampling._sample = None
+samples = []
+callers = [threading.Thread(target=lambda: samples.append(sampling.sample(['slow'])))
+           for _ in range(3)]
+for caller in callers:
+    caller.start()
+time.sleep(0.2)
+release.set()
+for caller in callers:
+    caller.join()
+assert len(slow_reads) == 3
+assert len({id(s) for s in samples}) == 1
+assert samples[0].reading['slow'] == 1.5
+assert sampling.sample(['slow']) is samples[0]
+assert [s.claim() for s in samples] == [True, False, False]
+assert sampling.sample(['slow']).claim() is False
+sampling._sample.taken -= sampling.SAMPLE_TTL
+assert sampling.sample(['slow']) is not samples[0]
+assert len(slow_reads) == 4
+del sensors.SENSORS['slow']
@@ -0,0 +1,80 @@
+'''
+Defines the backend metrics API, and records every request's timing
+when the POOL_METRICS config is set; see utils/instrumentation.py.
+When the POOL_PROFILE config is set, a request with a profile query
+parameter is also run under cProfile, and its profile dumped to
+POOL_PROFILE_DIR.
+'''
+import cProfile
+import os
+import pstats
+import tempfile
+from flask import Blueprint, Response, g
+from pool.utils.flask_utils import *
+from pool.utils import instrumentation
+from pool import schedule
+
+metrics = Blueprint('metrics', __name__)
+
+# whether ?profile profiles a request; set POOL_PROFILE in the environment
+# to turn it on. Profiling slows the request down a lot, so this is kept
+# apart from POOL_METRICS
+app.config.setdefault('POOL_PROFILE', bool(os.environ.get('POOL_PROFILE')))
+# where profiles of requests are dumped
+app.config.setdefault('POOL_PROFILE_DIR', tempfile.gettempdir())
+# functions listed when a profile is printed
+PROFILE_LINES = 20
+
+app.jinja_env.template_class = instrumentation.TimedTemplate
+
+
+@metrics.before_app_request
+def _start_request():
+    if instrumentation.enabled():
+        instrumentation.start_request()
+    if app.config['POOL_PROFILE'] and 'profile' in request.args:
+        g._profiler = cProfile.Profile()
+        g._profiler.enable()
+
+
+@metrics.after_app_request
+def _finish_request(response):
+    endpoint = request.endpoint or 'none'
+    profiler = g.pop('_profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        path = os.path.join(app.config['POOL_PROFILE_DIR'], '{}-{}.prof'
+                            .format(endpoint, int(1000 * time.time())))
+        profiler.dump_stats(path)
+        print('Profiled {} into {}'.format(request.full_path, path))
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(PROFILE_LINES)
+        response.headers['X-Profile'] = path
+    if instrumentation.enabled():
+        instrumentation.finish_request(
+            endpoint, None if response.is_streamed else response.calculate_content_length())
+    return response
+
+
+@metrics.teardown_app_request
+def _stop_profiler(exception):
+    '''Stops profiling requests which failed before finishing'''
+    profiler = g.pop('_profiler', None)
+    if profiler is not None:
+        profiler.disable()
+
+
+@metrics.route('/')
+def get_metrics():
+    '''Returns the histograms of utils/instrumentation.py and the runs of
+    each scheduled job, in the Prometheus text format'''
+    lines = []
+    jobs = schedule.get_job_stats()
+    for name, key, description in [
+            ('pool_job_runs_total', 'runs', 'Runs of each scheduled job'),
+            ('pool_job_failures_total', 'failures', 'Failed runs of each scheduled job')]:
+        lines += ['# HELP {} {}'.format(name, description),
+                  '# TYPE {} counter'.format(name)]
+        lines += ['{}{{job="{}"}} {}'.format(name, job_id, stats[key])
+                  for job_id, stats in sorted(jobs.items())]
+    body = instrumentation.render() + '\n'.join(lines) + '\n'
+    return Response(body, mimetype='text/plain; version=0.0.4')
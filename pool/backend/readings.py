@@ -1,17 +1,65 @@
 '''
 Defines the backend readings APIs 
 '''
+import bisect
+import io
+import json
+import queue
+import flask
+import numpy as np
 from flask import Blueprint, abort
 from pool.utils.flask_utils import *
+from pool.utils import serializers
 from pool.backend import dal
+from pool import sampling
 
 readings = Blueprint('readings', __name__)
 
+# readings returned per page by GET, unless limit says otherwise
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+# windows which ended longer ago than this are closed: their readings are
+# not expected to change, so clients may reuse them for CLOSED_WINDOW_MAX_AGE
+CLOSED_WINDOW_AGE = 24 * 60 * 60  # s
+CLOSED_WINDOW_MAX_AGE = 24 * 60 * 60  # s
+
+
+def extract_columns(name, default):
+    '''Extracts a comma separated list of Reading columns from the
+    query parameters'''
+    columns = extract_str(name)
+    if columns is None:
+        return default
+    columns = columns.split(',')
+    unknown = [c for c in columns if c not in dal.Reading.info]
+    if any(unknown):
+        abort(400, 'unknown columns: ' + ', '.join(unknown))
+    return columns
+
+
+def readings_validator():
+    '''Validator for conditional(): responses built from readings only
+    change with dal.get_data_version, and closed windows may be cached'''
+    version, modified = dal.get_data_version()
+    before = extract_int('before')
+    closed = before is not None and \
+        before < 1000 * (time.time() - CLOSED_WINDOW_AGE)
+    return version, modified, CLOSED_WINDOW_MAX_AGE if closed else None
+
 
 @readings.route('/', methods=['GET', 'POST', 'DELETE'])
+@conditional(readings_validator)
 @return_json
 def handle_reading():
-    '''Get or record a reading'''
+    '''Get, record or delete readings.
+    GET returns readings newest first, a page at a time, as
+    {'readings': [...], 'next': token}. Pass next back to get the
+    following page; it is null on the last one. limit sets the page size
+    and fields the comma separated columns to return.
+    POST accepts a single reading or a list of them; they are buffered
+    and stored in batches (see dal.buffer_readings). None are accepted
+    if any has the ts of a reading already stored or buffered.
+    '''
     if request.method == 'DELETE':
         data = request.get_json()
         try:
@@ -21,78 +69,223 @@ def handle_reading():
         dal.delete_reading_at(ts)
         return {"response": "OK"}
     if request.method == 'POST':
-        return dal.add_reading(request.get_json())
+        data = request.get_json()
+        if not isinstance(data, list):
+            data = [data]
+        if not all(isinstance(r, dict) for r in data):
+            abort(400, 'expected a reading or a list of readings')
+        try:
+            dal.buffer_readings(data)
+        except dal.DalException as e:
+            abort(400, str(e))
+        return {"response": "OK", "buffered": len(data)}
     else:
         after = extract_int('after', 0)
         before = extract_int('before', int(1000 * time.time()))
-        return [dal.as_dict(r) for r in dal.get_readings(after, before)]
+        cursor = extract_cursor('next')
+        if cursor is not None:
+            before = min(before, cursor - 1)
+        limit = extract_int('limit', DEFAULT_PAGE_SIZE)
+        if not 0 < limit <= MAX_PAGE_SIZE:
+            abort(400, 'limit should be between 1 and {}'.format(MAX_PAGE_SIZE))
+        fields = extract_columns('fields', [d[0] for d in dal.Reading.definitions])
+
+        # ts is needed for the cursor, and dropped by the writer if unwanted
+        columns = fields if 'ts' in fields else fields + ['ts']
+        page, more = dal.get_reading_rows_page(after, before, limit, columns)
+        write = serializers.json_writer(fields)
+        return {
+            'readings': [write(r) for r in page],
+            'next': encode_cursor(page[-1].ts) if more else None,
+        }
+
+
+# columns charted by the datatable, as (Reading column, label)
+CHART_COLUMNS = [
+    ('ph', 'pH'),
+    ('fc', 'Free Chlorine'),
+    ('tc', 'Total Chlorine'),
+    ('pool_temp', 'Pool Temperature'),
+]
+# the most rows the datatable returns unless asked otherwise, and at all
+DEFAULT_MAX_POINTS = 1000
+MAX_POINTS = 10000
 
 
 @readings.route('/datatable')
+@conditional(readings_validator)
 @return_json
 def get_readings_datatable():
     '''Returns a Google Visualization DataTable format
-    for the requested data'''
+    for the requested data.
+    Readings are averaged into time buckets so the table never holds
+    more than max_points rows (default DEFAULT_MAX_POINTS, and at most
+    MAX_POINTS). bucket sets the bucket width in ms, which is widened
+    where it would give more rows than that. Each charted column is
+    followed by interval columns holding the bucket's min and max, and
+    each bucket is annotated with the events of its readings.
+    '''
     after = extract_int('after', 0)
     before = extract_int('before', int(1000 * time.time()))
-    readings = dal.get_readings(after, before)
-
-    chart_data = {
-        'cols': [
-            {'id': 'when', 'label': 'Time', 'type': 'datetime'},
-            {'id': 'event', 'type': 'string', 'role': 'annotation'},
-            {'id': 'pH', 'label': 'pH', 'type': 'number'},
-            {'id': 'fc', 'label': 'Free Chlorine', 'type': 'number'},
-            {'id': 'tc', 'label': 'Total Chlorine', 'type': 'number'},
-            {'id': 'pool_temp', 'label': 'Pool Temperature', 'type': 'number'}
-        ],
-        'rows': [
-            {'c': [
-                {'v': 'Date({})'.format(r.ts)},
-                {'v': None},  # r.get_events_str()},
-                {'v': r.ph},
-                {'v': r.fc},
-                {'v': r.tc},
-                {'v': r.pool_temp}
-            ]} for r in readings
+    bucket = extract_int('bucket')
+    max_points = min(extract_int('max_points', DEFAULT_MAX_POINTS), MAX_POINTS)
+    if bucket is not None and bucket <= 0:
+        abort(400, 'bucket should be positive')
+    if max_points <= 0:
+        abort(400, 'max_points should be positive')
+
+    names = [c[0] for c in CHART_COLUMNS]
+    readings = dal.get_readings_bucketed(after, before, names,
+                                         bucket_ms=bucket,
+                                         max_points=max_points)
+
+    cols = [
+        {'id': 'when', 'label': 'Time', 'type': 'datetime'},
+        {'id': 'event', 'type': 'string', 'role': 'annotation'},
+    ]
+    for name, label in CHART_COLUMNS:
+        cols += [
+            {'id': name, 'label': label, 'type': 'number'},
+            {'id': name + '_min', 'type': 'number', 'role': 'interval'},
+            {'id': name + '_max', 'type': 'number', 'role': 'interval'},
         ]
-    }
-    return chart_data
+
+    # annotate each bucket with the events in it, oldest first
+    starts = [r.ts for r in reversed(readings)]
+    annotations = {}
+    for e in dal.get_events(after, before):
+        i = bisect.bisect_right(starts, e.reading_ts) - 1
+        if i >= 0:
+            annotations.setdefault(starts[i], []).append(str(e))
+
+    values = []
+    for name in names:
+        values += [name, name + '_min', name + '_max']
+    write = serializers.datatable_writer(values)
+    rows = []
+    for r in readings:
+        events = annotations.get(r.ts)
+        rows.append(write(r, '\n'.join(events) if events else None))
+
+    return {'cols': cols, 'rows': rows}
+
+
+# readings written to the csv per chunk of the response
+CSV_CHUNK_SIZE = 1000
 
 
 @readings.route('/csv', methods=['GET'])
+@conditional(readings_validator)
 def get_readings_csv():
-    '''Returns requested readings as a csv'''
+    '''Returns requested readings as a csv.
+    Readings are streamed as they are read from the database, gzipped
+    if the client accepts it. columns optionally selects which columns
+    to include, as a comma separated list.
+    '''
     after = extract_int('after', 0)
     before = extract_int('before', int(1000 * time.time()))
-    readings = dal.get_readings(after, before)
-
-    indexes = [d[0] for d in dal.Reading.definitions]
+    indexes = extract_columns('columns', [d[0] for d in dal.Reading.definitions])
 
     def generate():
         yield ','.join(indexes) + '\n'
-        for r in readings:
-            yield str(r) + '\n'
-    return flask.Response(generate(), mimetype='text/csv')
+        write = serializers.csv_writer(indexes)
+        lines = []
+        for r in dal.iter_reading_rows(after, before, indexes,
+                                       batch_size=CSV_CHUNK_SIZE):
+            lines.append(write(r))
+            if len(lines) == CSV_CHUNK_SIZE:
+                yield ''.join(lines)
+                lines = []
+        if any(lines):
+            yield ''.join(lines)
+    return stream_response(generate(), mimetype='text/csv')
+
+
+@readings.route('/npz', methods=['GET'])
+@conditional(readings_validator)
+def get_readings_npz():
+    '''Returns requested readings as typed columns in a NumPy .npz file.
+    Each column is an array (int64 for ts, float32 otherwise, with NaN
+    for missing values) alongside a bool <column>_mask array that is
+    True where the value is present. Readings are oldest first.
+    columns optionally selects which columns to include.
+    '''
+    after = extract_int('after', 0)
+    before = extract_int('before', int(1000 * time.time()))
+    columns = extract_columns('columns', [d[0] for d in dal.Reading.definitions])
+
+    arrays = {}
+    for name, (values, mask) in dal.get_readings_columns(after, before, columns).items():
+        arrays[name] = values
+        arrays[name + '_mask'] = mask
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    response = flask.Response(buffer.getvalue(), mimetype='application/octet-stream')
+    response.headers['Content-Disposition'] = 'attachment; filename=readings.npz'
+    return response
+
+
+# seconds between comments sent on idle streams, so that clients (and
+# the server) notice connections which have gone away
+STREAM_HEARTBEAT = 15
+# seconds between checks of idle streams for readings and events stored
+# by other processes, which this process only publishes once it notices
+STREAM_POLL = 2
+
+
+@readings.route('/stream')
+def stream_readings():
+    '''Streams readings and events as they are stored, by any process,
+    as Server-Sent Events: a 'reading' event with the reading's columns,
+    or an 'event' event with the event's columns and its text. Readings
+    buffered by this process are sent once buffered; those of other
+    processes once they store them (see dal.buffer_readings). Nothing is
+    sent for what was stored before connecting, nor for readings being
+    edited or deleted, so clients should fetch the window they show when
+    the stream (re)opens, then apply these.
+    '''
+    subscriber = dal.hub.subscribe()
+
+    def generate():
+        try:
+            yield 'retry: 5000\n\n'
+            sent = time.time()
+            while True:
+                try:
+                    kind, data = subscriber.get(timeout=STREAM_POLL)
+                except queue.Empty:
+                    # closing the stream makes a dropped client reconnect
+                    if not dal.hub.is_subscribed(subscriber):
+                        return
+                    dal.refresh_settings()
+                    if time.time() - sent >= STREAM_HEARTBEAT:
+                        sent = time.time()
+                        yield ': heartbeat\n\n'
+                    continue
+                sent = time.time()
+                yield 'event: {}\ndata: {}\n\n'.format(kind, json.dumps(data))
+        finally:
+            dal.hub.unsubscribe(subscriber)
+    # generated within the request's context, so the database session
+    # used by refresh_settings is removed when the stream ends
+    response = flask.Response(flask.stream_with_context(generate()),
+                              mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # stop proxies such as nginx from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 
 @readings.route('/current')
 @return_json
 def take_reading():
-    '''Takes a reading immediately and returns its value'''
-    water_temp = sensors.get_water_temperature()
-    if dal.should_compensate(water_temp):
-        dal.update_setting('compensation_delta', water_temp)
-        sensors.set_pH_temp_compensation(water_temp)
-
-    reading = {
-        'pool_temp': water_temp,
-        'ph': sensors.get_pH(),
-        'air_temp': sensors.get_air_temperature(),
-        'cpu_temp': sensors.get_internal_temperature()
-    }
-
-    if 'store' in request.args and str_to_bool(request.args['store']):
-        dal.add_reading(reading)
-
-    return reading
+    '''Returns a reading of every sensor, taken within the last
+    sampling.SAMPLE_TTL seconds. If store is true, the reading is stored,
+    unless it has been already.
+    '''
+    sample = sampling.sample()
+    if 'store' in request.args and str_to_bool(request.args['store']) and \
+            sample.claim():
+        dal.add_reading(sample.reading)
+
+    return sample.reading
@@ -0,0 +1,120 @@
+'''
+Estimates chlorine decay, demand and dosing from fc readings and events.
+The fc series is split into segments at each ADD-CL event, and the decay
+of free chlorine after each dose is fitted as an exponential. Fits are
+cached per segment, and only recomputed when readings or events in the
+segment change.
+'''
+import math
+import threading
+import time
+
+import numpy as np
+
+from pool.backend import dal
+from pool.utils import chemistry
+
+HOUR_MS = 60 * 60 * 1000
+
+# fitted segments by (start, end); see get_segments
+_fits = {}
+# bumped by every change, so fits made while one happens are not cached
+_generation = 0
+_fits_lock = threading.Lock()
+
+
+@dal.on_change
+def _invalidate(after, before):
+    '''Drops the fits of segments overlapping changed readings or events'''
+    global _generation
+    with _fits_lock:
+        _generation += 1
+        for start, end in list(_fits):
+            if start <= before and (end is None or end > after):
+                del _fits[(start, end)]
+
+
+def _fit_segment(start, end):
+    last = end - 1 if end is not None else 2 ** 62
+    # fc on the dose's own reading was most likely tested before the dose
+    measurements = dal.get_measurements(start + 1, last, 'fc')
+    events = dal.get_events(start, last)
+    segment = {
+        'start': start,
+        'end': end,
+        'added': sum(e.quantity or 0 for e in events
+                     if e.event_type == 'ADD-CL' and e.reading_ts == start),
+        'swim_load': sum(e.quantity or 1 for e in events if e.event_type == 'SWIM'),
+        'weather_events': sum(1 for e in events if e.event_type == 'WEATHER'),
+        'measurements': len(measurements),
+        'fc0': None,
+        'decay_per_day': None,
+        'half_life_hours': None,
+    }
+    if len(measurements) >= 2:
+        ts, fc = (np.array(c, dtype=np.float64) for c in zip(*measurements))
+        fit = chemistry.fit_decay((ts - start) / HOUR_MS, fc)
+        if fit is not None:
+            fc0, k = fit
+            segment['fc0'] = fc0
+            segment['decay_per_day'] = 24 * k
+            segment['half_life_hours'] = math.log(2) / k if k > 0 else None
+    return segment
+
+
+def get_segments():
+    '''Returns a dict for every ADD-CL dose, oldest first, describing
+    the segment until the next: its start and end ts (None for the
+    current one), the chlorine added (gal), the swim load and weather
+    events during it, the number of fc measurements, and the fitted fc0
+    (fc just after the dose), decay_per_day (the decay rate) and
+    half_life_hours, which are None if there were too few measurements.
+    '''
+    starts = sorted({e.reading_ts for e in
+                     dal.get_events_by_kind(0, 2 ** 62, 'ADD-CL')})
+    bounds = list(zip(starts, starts[1:] + [None]))
+    with _fits_lock:
+        generation = _generation
+        fits = {b: _fits[b] for b in bounds if b in _fits}
+
+    missing = {b: _fit_segment(*b) for b in bounds if b not in fits}
+    with _fits_lock:
+        if generation == _generation:
+            _fits.update(missing)
+    fits.update(missing)
+    return [fits[b] for b in bounds]
+
+
+def get_estimate(now=None):
+    '''Returns the current chlorine picture: the fc predicted now from
+    the current segment's decay (or the last fc reading, if it has no
+    fit), the fc_target setting, the demand (ppm lost per day at the
+    target) from the latest fitted decay, and the chlorine needed to
+    reach the target now and to hold it for a day, in gal.
+    '''
+    now = now or time.time()
+    settings = dal.get_settings()
+    target = settings['fc_target']
+    segments = get_segments()
+
+    fitted = [s for s in segments if s['decay_per_day'] is not None]
+    k = fitted[-1]['decay_per_day'] / 24 if any(fitted) else None
+    current = segments[-1] if any(segments) else None
+    if current is not None and current['fc0'] is not None:
+        hours = (1000 * now - current['start']) / HOUR_MS
+        fc = current['fc0'] * math.exp(-k * hours)
+    else:
+        fc = dal.get_latest_values()['fc'][1]
+
+    demand = target * (1 - math.exp(-24 * k)) if k is not None else None
+
+    def dose(ppm):
+        return chemistry.chlorine_dose(max(0, ppm), settings['pool_volume'],
+                                       settings['chlorine_strength'])
+    return {
+        'fc_predicted': fc,
+        'fc_target': target,
+        'demand_ppm_per_day': demand,
+        'dose_now': dose(target - fc) if fc is not None else None,
+        'dose_per_day': dose(demand) if demand is not None else None,
+    }
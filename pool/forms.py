@@ -46,3 +46,15 @@ class SettingsForm(Form):
                               [Optional(), NumberRange(min=1, max=30)])
     reading_interval = IntegerField('Reading Interval',
                                     [Optional(), NumberRange(min=0, max=3600)])
+    raw_retention = IntegerField('Keep Readings',
+                                 [Optional(), NumberRange(min=0)])
+    hourly_retention = IntegerField('Keep Hourly Averages',
+                                    [Optional(), NumberRange(min=0)])
+    daily_retention = IntegerField('Keep Daily Averages',
+                                   [Optional(), NumberRange(min=0)])
+    pool_volume = IntegerField('Pool Volume',
+                               [Optional(), NumberRange(min=1)])
+    chlorine_strength = FloatField('Chlorine Strength',
+                                   [Optional(), NumberRange(min=0.1, max=100)])
+    fc_target = FloatField('Target Free Chlorine',
+                           [Optional(), NumberRange(min=0, max=50)])
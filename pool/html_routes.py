@@ -1,7 +1,7 @@
 from pool import app
 
 import datetime
-from flask import request, render_template, flash, redirect
+from flask import request, render_template, flash, redirect, session
 from sqlalchemy.exc import IntegrityError
 
 from pool.utils.flask_utils import *
@@ -14,37 +14,53 @@ import pool.schedule
 import pool.backend.readings
 import pool.backend.events
 import pool.backend.settings
+import pool.backend.analytics
+import pool.backend.metrics
 app.register_blueprint(pool.backend.readings.readings,
                        url_prefix='/backend/readings')
 app.register_blueprint(pool.backend.events.events,
                        url_prefix='/backend/events')
 app.register_blueprint(pool.backend.settings.settings,
                        url_prefix='/backend/settings')
+app.register_blueprint(pool.backend.analytics.analytics,
+                       url_prefix='/backend/analytics')
+app.register_blueprint(pool.backend.metrics.metrics,
+                       url_prefix='/backend/metrics')
 
 READING_DATA = ['fc', 'tc', 'ph', 'ta', 'ca', 'cya', 'pool_temp']
+# readings rendered per page of the reading list
+READINGS_PAGE_SIZE = 100
+
+
+def dashboard_validator():
+    '''Validator for conditional(): the dashboard only changes with the
+    readings, unless there are flashed messages waiting to be shown'''
+    if session.get('_flashes'):
+        return None
+    version, modified = dal.get_data_version()
+    return version, modified, None
 
 
 @app.route('/')
+@conditional(dashboard_validator)
 def get_index():
     '''Dashboard page'''
     to_return = [
         'fc', 'tc', 'ph', 'ta', 'ca', 'cya', 'pool_temp'
     ]
-    readings = {n: dal.get_most_recent(n) for n in to_return}
-    values = {n: getattr(readings[n], n) if readings[n] is not None else None
-              for n in to_return}
+    latest = dal.get_latest_values()
+    values = {n: latest[n][1] for n in to_return}
 
     categories = []
     for name in to_return:
         display, units = dal.Reading.info[name]
-        r = readings[name]
-        v = values[name]
+        ts, v = latest[name]
         categories.append(
             {
                 'name': display,
-                'value': str(v) if r is not None else '-',
+                'value': str(v) if ts is not None else '-',
                 'unit': units,
-                'when': r.ts if r is not None else '-'
+                'when': ts if ts is not None else '-'
             }
         )
 
@@ -67,10 +83,18 @@ def get_readings():
 
 @app.route('/readings/list')
 def get_readings_list():
+    '''Renders a page of readings, newest first. If there are more,
+    it ends with a button to load the next page, passing next back'''
     after = extract_int('after', 0)
     before = extract_int('before', int(1000 * time.time()))
-    readings = dal.get_readings(after, before)
-    return render_template('reading_list.html', readings=readings)
+    cursor = extract_cursor('next')
+    if cursor is not None:
+        before = min(before, cursor - 1)
+    readings, more = dal.get_readings_page(after, before, READINGS_PAGE_SIZE,
+                                           with_events=True)
+    next_cursor = encode_cursor(readings[-1].ts) if more else None
+    return render_template('reading_list.html', readings=readings,
+                           next=next_cursor, first_page=cursor is None)
 
 
 @app.route('/readings/add', methods=['GET', 'POST'])
@@ -162,7 +186,13 @@ def display_settings():
     if request.method == 'POST' and form.validate:
         new_settings = {
             'compensation_delta': form.comp_delta.data,
-            'reading_interval': form.reading_interval.data
+            'reading_interval': form.reading_interval.data,
+            'raw_retention_days': form.raw_retention.data,
+            'hourly_retention_days': form.hourly_retention.data,
+            'daily_retention_days': form.daily_retention.data,
+            'pool_volume': form.pool_volume.data,
+            'chlorine_strength': form.chlorine_strength.data,
+            'fc_target': form.fc_target.data,
         }
         dal.update_settings(new_settings)
         updated_settings = dal.get_settings()
@@ -180,44 +210,46 @@ def display_events():
 
 
 class SummaryStat():
-    def __init__(self, event_type, event_info):
+    '''Summary of one type of event, from a row of dal.get_event_summary
+    (or None, if there were no events of that type)'''
+
+    def __init__(self, event_type, event_info, row=None):
         self.event_type = event_type
         self.display = event_info[0]
         self.unit = event_info[1]
-        self.sum_total = 0
-        self.mean = 0
-        self.num_instances = 0
+        self.num_instances = row.count if row else 0
+        self.sum_total = row.total if row else 0
+        self.mean = row.mean if row else 0
+        self.min = row.min if row else None
+        self.max = row.max if row else None
+        self.first = row.first if row else None
+        self.last = row.last if row else None
         self.comments = []
 
-    def count(self, quantity, comment):
-        self.num_instances += 1
-        if quantity is not None:
-            self.sum_total += quantity
-        else:
-            self.sum_total += 1
-        self.mean = self.sum_total / self.num_instances
-        if comment is not None:
-            self.comments.append(comment)
+
+# the most comments shown on the event summary, newest first
+EVENT_COMMENT_LIMIT = 100
 
 
 @app.route('/events/list')
 def get_events_lists():
     after = extract_int('after', 0)
     before = extract_int('before', int(1000 * time.time()))
-    events = dal.get_events(after, before)
 
-    stats = {et: SummaryStat(et, dal.EVENT_TYPES[et])
+    rows = {r.event_type: r for r in dal.get_event_summary(after, before)}
+    stats = {et: SummaryStat(et, dal.EVENT_TYPES[et], rows.get(et))
              for et in dal.EVENT_TYPES.keys()}
 
-    has_comments = False
-    for e in events:
-        if e.comment:
-            has_comments = True
-            c = '{}: {}'.format(ms_to_str(e.reading_ts), e.comment)
-        else:
-            c = None
-        stats[e.event_type].count(e.quantity, c)
+    comments = dal.get_event_comments(after, before, EVENT_COMMENT_LIMIT + 1)
+    more_comments = len(comments) > EVENT_COMMENT_LIMIT
+    # shown oldest first under each type
+    for c in reversed(comments[:EVENT_COMMENT_LIMIT]):
+        stats[c.event_type].comments.append(
+            '{}: {}'.format(ms_to_str(c.reading_ts), c.comment))
 
     stats = [stats[et] for et in sorted(dal.EVENT_TYPES.keys())]
 
-    return render_template('event_summary.html', stats=stats, has_comments=has_comments)
+    return render_template('event_summary.html', stats=stats,
+                           has_comments=any(comments),
+                           more_comments=more_comments,
+                           comment_limit=EVENT_COMMENT_LIMIT)
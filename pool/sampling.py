@@ -0,0 +1,156 @@
+'''
+Takes readings from the sensors
+'''
+from concurrent import futures
+import threading
+import time
+
+from pool import sensors
+from pool.backend import dal
+
+# seconds to wait for each sensor before leaving its value out of a reading;
+# sensors which usually take longer get TIMEOUT_COSTS times their cost
+SENSOR_TIMEOUT = 2.0
+TIMEOUT_COSTS = 3
+# sensors are read on these threads so slow probes overlap. A probe which
+# hangs keeps its thread busy, so there are spare threads for the others
+_executor = futures.ThreadPoolExecutor(max_workers=8)
+# the latest read of each sensor, by metric; see _submit
+_reads = {}
+_reads_lock = threading.Lock()
+
+
+def _submit(metric, read, *args):
+    '''Starts read(*args) of a sensor on _executor and returns its future,
+    or None if the sensor's previous read is still running. A probe which
+    hangs then only ever holds one thread, rather than one per reading
+    until every thread is stuck and no sensor can be read.
+    '''
+    with _reads_lock:
+        previous = _reads.get(metric)
+        if previous is not None and not previous.done():
+            return None
+        future = _reads[metric] = _executor.submit(read, *args)
+        return future
+
+
+def _result(metric, future, started):
+    '''Returns a sensor's value, or None if it failed, took too long, or
+    is still busy with an earlier read'''
+    if future is None:
+        print('Not reading {}: an earlier read has not returned'.format(metric))
+        return None
+    timeout = max(SENSOR_TIMEOUT, TIMEOUT_COSTS * sensors.SENSORS[metric].cost)
+    try:
+        return future.result(max(0, started + timeout - time.time()))
+    except futures.TimeoutError:
+        print('Timed out reading {}'.format(metric))
+    except Exception as e:
+        print('Failed to read {}: {}'.format(metric, e))
+    return None
+
+
+def _read_pH(compensate_to):
+    if compensate_to is not None:
+        sensors.set_pH_temp_compensation(compensate_to)
+    return sensors.SENSORS['ph'].read()
+
+
+def take_reading(metrics=None):
+    '''Reads the sensors of the given metrics (by default, every sensor
+    in sensors.SENSORS). Independent sensors are read concurrently.
+    The pH probe is read once the water temperature is known, after
+    updating its temperature compensation if the water temperature has
+    drifted, so reading ph also reads pool_temp.
+    Returns the reading as a dict, without the values of any sensors
+    which failed or timed out.
+    '''
+    if metrics is None:
+        metrics = sensors.SENSORS
+    metrics = set(metrics)
+    if 'ph' in metrics:
+        metrics.add('pool_temp')
+
+    start = time.time()
+    pending = {m: _submit(m, sensors.SENSORS[m].read)
+               for m in metrics if m != 'ph'}
+    reading = {}
+    if 'ph' in metrics:
+        water_temp = _result('pool_temp', pending.pop('pool_temp'), start)
+        compensate_to = None
+        if water_temp is not None and dal.should_compensate(water_temp):
+            dal.update_setting('compensation_temp', water_temp)
+            compensate_to = water_temp
+        ph_start = time.time()
+        reading['pool_temp'] = water_temp
+        reading['ph'] = _result('ph', _submit('ph', _read_pH, compensate_to),
+                                ph_start)
+    for metric, future in pending.items():
+        reading[metric] = _result(metric, future, start)
+    return {m: value for m, value in reading.items() if value is not None}
+
+
+# samples younger than this many seconds are shared by callers of sample
+SAMPLE_TTL = 5.0
+
+
+class Sample():
+    '''A reading of some sensors (metrics), timestamped when it was taken,
+    and shared by everyone who asks for those sensors while it is fresh.
+    Sharers which store it should claim it first, so it is stored once.
+    '''
+
+    def __init__(self, metrics, reading):
+        self.metrics = frozenset(metrics)
+        self.taken = time.time()
+        self.reading = dict(reading, ts=int(1000 * self.taken))
+        self._claimed = False
+        self._lock = threading.Lock()
+
+    def claim(self):
+        '''Returns true for the first caller only'''
+        with self._lock:
+            claimed, self._claimed = self._claimed, True
+            return not claimed
+
+
+# the newest sample taken, and samples being taken by metrics; see sample
+_sample = None
+_in_flight = {}
+_sample_lock = threading.Lock()
+
+
+def sample(metrics=None):
+    '''Returns a Sample of the given metrics (by default, every sensor).
+    A sample of those sensors less than SAMPLE_TTL old is reused, and
+    callers arriving while one is being taken wait for it, so the
+    probes are only read once however many callers there are.
+    '''
+    global _sample
+    metrics = frozenset(sensors.SENSORS if metrics is None else metrics)
+    with _sample_lock:
+        if _sample is not None and metrics <= _sample.metrics and \
+                time.time() - _sample.taken < SAMPLE_TTL:
+            return _sample
+        future = next((f for taking, f in _in_flight.items()
+                       if metrics <= taking), None)
+        if future is not None:
+            waiting = True
+        else:
+            waiting = False
+            future = _in_flight[metrics] = futures.Future()
+    if waiting:
+        return future.result()
+
+    try:
+        taken = Sample(metrics, take_reading(metrics))
+    except Exception as e:
+        with _sample_lock:
+            del _in_flight[metrics]
+        future.set_exception(e)
+        raise
+    with _sample_lock:
+        del _in_flight[metrics]
+        _sample = taken
+    future.set_result(taken)
+    return taken
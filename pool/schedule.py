@@ -2,42 +2,296 @@
 Handles scheduled jobs for the pool software.
 '''
 import atexit
-import requests
+import datetime
+import fcntl
+import functools
+import math
+import os
+import threading
+import time
 
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.base import BaseTrigger
 from apscheduler.triggers.interval import IntervalTrigger
 import apscheduler
 
+from pool import app, sampling, sensors
+from pool.utils import instrumentation
+from pool.backend import dal
+
 READING_JOB_ID = 'reading_job'
+FLUSH_JOB_ID = 'flush_job'
+COMPACT_JOB_ID = 'compact_job'
+SETTINGS_JOB_ID = 'settings_job'
+ELECTION_JOB_ID = 'election_job'
+# how often the leader checks for settings changed by other processes,
+# and how often other processes try to take over from it (s)
+SETTINGS_INTERVAL = 10
+ELECTION_INTERVAL = 30
+# the file whose lock makes a process the leader; see _elect
+app.config.setdefault('POOL_SCHEDULER_LOCK', dal.lock_path('scheduler'))
+# whether each scheduled reading is stored at once rather than with the
+# next batch (see dal.buffer_readings). Streams served by this process get
+# readings as soon as they are buffered either way; turning this on also
+# gets them to streams served by other processes (such as other WSGI
+# workers) straight away, at the cost of a transaction per reading
+app.config.setdefault('POOL_STORE_READINGS_AT_ONCE', False)
+# the most of the time a sensor may keep the bus busy: a sensor is read
+# at most once every cost / MAX_BUS_SHARE seconds, whatever its period
+MAX_BUS_SHARE = 0.5
 SCHEDULER = BackgroundScheduler()
 SCHEDULER.start()
-PORT = 5000
-atexit.register(lambda: SCHEDULER.shutdown())
 
 
+def _shutdown():
+    '''Stops the scheduler, then stores any buffered readings'''
+    SCHEDULER.shutdown()
+    with app.app_context():
+        dal.flush_readings()
+
+
+atexit.register(_shutdown)
+
+# timing of each job's runs, keyed by job id; see get_job_stats
+_job_stats = {}
+_job_stats_lock = threading.Lock()
+
+
+def _job(job_id):
+    '''Decorator for scheduled jobs.
+    Jobs run on the scheduler's threads, so each run gets its own app
+    context. Flask-SQLAlchemy scopes db.session to it, giving the job a
+    session of its own which is removed when the run finishes.
+    Settings changed by other processes are reloaded before each run.
+    The duration and outcome of every run are recorded.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def inner(*a, **k):
+            start = time.time()
+            failed = True
+            try:
+                with app.app_context():
+                    dal.refresh_settings()
+                    result = func(*a, **k)
+                failed = False
+                return result
+            finally:
+                _record_run(job_id, time.time() - start, failed)
+        return inner
+    return decorator
+
+
+def _record_run(job_id, duration, failed):
+    with _job_stats_lock:
+        stats = _job_stats.setdefault(job_id, {
+            'runs': 0,
+            'failures': 0,
+            'last_s': 0.0,
+            'total_s': 0.0,
+            'max_s': 0.0,
+        })
+        stats['runs'] += 1
+        stats['failures'] += 1 if failed else 0
+        stats['last_s'] = duration
+        stats['total_s'] += duration
+        stats['max_s'] = max(stats['max_s'], duration)
+    instrumentation.record_job(job_id, duration)
+
+
+def get_job_stats():
+    '''Returns the timing of each job's runs so far, as
+    {job id: {'runs', 'failures', 'last_s', 'total_s', 'max_s'}},
+    with durations in seconds.
+    '''
+    with _job_stats_lock:
+        return {job_id: dict(stats) for job_id, stats in _job_stats.items()}
+
+
+# how often each sensor is read and when it is next due (s since epoch),
+# by metric; see set_reading_interval
+_periods = {}
+_next_due = {}
+_sampling_lock = threading.Lock()
+# how late (s) a sensor may be read, so that runs which fire a little
+# early or late still read the sensors due at that time
+DUE_SLACK = 0.5
+
+
+class _SensorTrigger(BaseTrigger):
+    '''Fires whenever any sensor is due: at every multiple of each of
+    periods (s) after start (s since epoch), so sensors whose reads fall
+    at the same time are read together, and runs never find nothing due
+    '''
+    __slots__ = ('periods', 'start')
+
+    def __init__(self, periods, start):
+        self.periods = sorted(set(periods))
+        self.start = start
+
+    def get_next_fire_time(self, previous_fire_time, now):
+        elapsed = now.timestamp() - self.start
+        if previous_fire_time is not None:
+            elapsed = max(elapsed, previous_fire_time.timestamp() - self.start)
+        offset = min(p * (int(elapsed // p) + 1) for p in self.periods)
+        return datetime.datetime.fromtimestamp(self.start + offset, now.tzinfo)
+
+
+def _due_sensors(now):
+    '''Returns the metrics of the sensors due to be read, and
+    schedules their next reads'''
+    with _sampling_lock:
+        due = [m for m, t in _next_due.items() if t <= now + DUE_SLACK]
+        for m in due:
+            # a run which fell behind skips the reads it missed
+            while _next_due[m] <= now + DUE_SLACK:
+                _next_due[m] += _periods[m]
+    return due
+
+
+@_job(READING_JOB_ID)
 def _record_reading():
-    '''Sends a request to record a reading.
-    This operates over HTTP so that db interactions
-    happen on the same thread.
+    '''Reads the sensors which are due and buffers their values as one
+    reading'''
+    due = _due_sensors(time.time())
+    if not any(due):
+        return
+    sample = sampling.sample(due)
+    # a sample shared with /current may already have been stored
+    if sample.claim() and len(sample.reading) > 1:
+        dal.buffer_readings([sample.reading])
+        if app.config['POOL_STORE_READINGS_AT_ONCE']:
+            dal.flush_readings()
+
+
+@_job(FLUSH_JOB_ID)
+def _flush_readings():
+    '''Stores buffered readings which have not filled a batch'''
+    dal.flush_readings()
+
+
+@_job(COMPACT_JOB_ID)
+def _compact_readings():
+    '''Deletes readings and rollups past their retention'''
+    dal.compact_readings()
+
+
+@_job(SETTINGS_JOB_ID)
+def _apply_settings():
+    '''Applies a reading interval set by another process'''
+    interval = dal.get_settings()['reading_interval']
+    if interval != _reading_interval:
+        set_reading_interval(interval)
+
+
+@_job(ELECTION_JOB_ID)
+def _run_election():
+    _elect()
+
+
+# readings are buffered by whichever process receives them, so every
+# process flushes its own
+SCHEDULER.add_job(
+    func=_flush_readings,
+    trigger=IntervalTrigger(seconds=app.config['POOL_INGEST_MAX_AGE']),
+    id=FLUSH_JOB_ID
+)
+
+# the reading interval last set, and the leader's open lock file
+_reading_interval = None
+_lock_file = None
+
+
+def is_leader():
+    '''Returns true if this process runs the jobs which must only run in
+    one process, such as taking readings, when there are several (such
+    as WSGI workers)'''
+    return _lock_file is not None
+
+
+def _elect():
+    '''Makes this process the leader if no other process is, by holding
+    an exclusive lock on POOL_SCHEDULER_LOCK for as long as it runs.
+    The lock is released when the process exits, however it does, so
+    other processes keep trying to take over every ELECTION_INTERVAL.
     '''
-    reading = requests.get(
-        'http://localhost:{}/readings/current?store=true'.format(PORT))
+    global _lock_file
+    lock_file = open(app.config['POOL_SCHEDULER_LOCK'], 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        if SCHEDULER.get_job(ELECTION_JOB_ID) is None:
+            SCHEDULER.add_job(
+                func=_run_election,
+                trigger=IntervalTrigger(seconds=ELECTION_INTERVAL),
+                id=ELECTION_JOB_ID
+            )
+        return False
+
+    _lock_file = lock_file
+    print('Process {} is running the scheduled jobs'.format(os.getpid()))
+    if SCHEDULER.get_job(ELECTION_JOB_ID) is not None:
+        SCHEDULER.remove_job(ELECTION_JOB_ID)
+    SCHEDULER.add_job(
+        func=_compact_readings,
+        trigger=IntervalTrigger(seconds=app.config['POOL_COMPACTION_INTERVAL']),
+        id=COMPACT_JOB_ID
+    )
+    SCHEDULER.add_job(
+        func=_apply_settings,
+        trigger=IntervalTrigger(seconds=SETTINGS_INTERVAL),
+        id=SETTINGS_JOB_ID
+    )
+    if _reading_interval is not None:
+        set_reading_interval(dal.get_settings()['reading_interval'])
+    return True
+
+
+def sensor_periods(reading_interval):
+    '''Returns how often each sensor in sensors.SENSORS is read, in whole
+    seconds: its own period, or reading_interval if it has none, but
+    never so often that it holds the bus for more than MAX_BUS_SHARE'''
+    periods = {}
+    for metric, sensor in sensors.SENSORS.items():
+        period = sensor.period if sensor.period is not None else reading_interval
+        periods[metric] = max(1, int(period),
+                              math.ceil(sensor.cost / MAX_BUS_SHARE))
+    return periods
 
 
 def set_reading_interval(seconds):
-    '''Sets up a job to regularly take readings. 
-    If the interval is <= 0, no readings are taken. 
+    '''Sets up a job to regularly take readings.
+    Sensors without a period of their own are read every interval, and
+    the rest at their own rates. The job runs whenever any of them is
+    due, and each run stores the sensors due as one reading.
+    If the interval is <= 0, no readings are taken.
+    Only the leader takes readings; other processes remember the interval
+    in case they become leader.
     '''
-    if SCHEDULER.get_job(READING_JOB_ID) is None:
-        if seconds <= 0:
-            return
-        SCHEDULER.add_job(
-            func=_record_reading,
-            trigger=IntervalTrigger(seconds=seconds),
-            id=READING_JOB_ID
-        )
-    elif seconds > 0:
-        SCHEDULER.reschedule_job(READING_JOB_ID,
-                                 trigger=IntervalTrigger(seconds=seconds))
-    else:
-        SCHEDULER.pause_job(READING_JOB_ID)
+    global _reading_interval
+    _reading_interval = seconds
+    if not is_leader():
+        return
+    if seconds <= 0:
+        if SCHEDULER.get_job(READING_JOB_ID) is not None:
+            SCHEDULER.remove_job(READING_JOB_ID)
+        return
+
+    periods = sensor_periods(seconds)
+    start = int(time.time())
+    with _sampling_lock:
+        _periods.clear()
+        _periods.update(periods)
+        _next_due.clear()
+        _next_due.update({m: start for m in periods})
+
+    SCHEDULER.add_job(
+        func=_record_reading,
+        trigger=_SensorTrigger(periods.values(), start),
+        id=READING_JOB_ID,
+        replace_existing=True
+    )
+
+
+_elect()
@@ -37,3 +37,35 @@ def get_air_temperature():
 def get_internal_temperature():
     '''Returns the current temperature of the Pi'''
     return random.randint(40, 50)
+
+
+class Sensor():
+    '''A driver for one Reading column (its metric).
+    read returns the metric's current value. cost is roughly how many
+    seconds a read keeps the probe's bus busy, and period is how often
+    the sensor should be read, in seconds, or None to read it with every
+    reading (see schedule.set_reading_interval).
+    '''
+
+    def __init__(self, metric, read, cost, period=None):
+        self.metric = metric
+        self.read = read
+        self.cost = cost
+        self.period = period
+
+
+# registered sensors, by metric
+SENSORS = {}
+
+
+def register(sensor):
+    '''Adds a sensor to those read by sampling.take_reading, replacing
+    any already registered for its metric'''
+    SENSORS[sensor.metric] = sensor
+    return sensor
+
+
+register(Sensor('pool_temp', get_water_temperature, cost=0.75))
+register(Sensor('ph', get_pH, cost=1.0, period=300))
+register(Sensor('air_temp', get_air_temperature, cost=0.75))
+register(Sensor('cpu_temp', get_internal_temperature, cost=0.01, period=30))
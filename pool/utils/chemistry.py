@@ -0,0 +1,85 @@
+'''
+Water chemistry over whole series of readings at once, using NumPy.
+Series are float arrays with NaN where a value is unknown.
+'''
+import numpy as np
+
+
+def forward_fill(values, mask, seed=np.nan):
+    '''Returns values with each missing value (where mask is false)
+    replaced by the last value present before it, or by seed if there
+    is none. This suits columns which are only measured now and then,
+    such as calcium hardness, which hold until they are next measured.
+    '''
+    last = np.where(mask, np.arange(len(values)), -1)
+    np.maximum.accumulate(last, out=last)
+    return np.where(last >= 0, values[last], seed)
+
+
+def saturation_index(pH, temp, ca, ta, tds=320):
+    '''Returns the Langelier Saturation Index of each reading;
+    see calcs.saturation_index'''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        A = np.log10(tds - 1) / 10
+        B = -13.12 * np.log10(temp + 273) + 34.55
+        C = np.log10(ca) - 0.4
+        D = np.log10(ta)
+    pHs = (9.3 + A + B) - (C + D)
+    return pH - pHs
+
+
+def fc_cya_ratio(fc, cya):
+    '''Returns free chlorine as a fraction of cyanuric acid, which
+    decides how much of it is active; NaN where there is no cya'''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(cya > 0, fc / cya, np.nan)
+
+
+def combined_chlorine(tc, fc):
+    '''Returns the chlorine bound up as chloramines'''
+    return tc - fc
+
+
+# reading columns needed by water_chemistry
+COLUMNS = ['ph', 'pool_temp', 'fc', 'tc', 'ta', 'ca', 'cya']
+
+
+def water_chemistry(columns, seeds=None):
+    '''Returns {'lsi', 'fc_cya', 'cc'} series for readings given as
+    {column: (values, mask)} columns (see dal.get_readings_columns),
+    holding at least COLUMNS. Each column is forward filled first, from
+    seeds[column] (such as its last value before the readings) if given.
+    '''
+    seeds = seeds or {}
+    filled = {}
+    for c in COLUMNS:
+        values, mask = columns[c]
+        filled[c] = forward_fill(np.asarray(values, dtype=np.float64),
+                                 np.asarray(mask, dtype=bool),
+                                 np.nan if seeds.get(c) is None else seeds[c])
+    return {
+        'lsi': saturation_index(filled['ph'], filled['pool_temp'],
+                                filled['ca'], filled['ta']),
+        'fc_cya': fc_cya_ratio(filled['fc'], filled['cya']),
+        'cc': combined_chlorine(filled['tc'], filled['fc']),
+    }
+
+
+def fit_decay(hours, fc):
+    '''Fits fc = fc0 * exp(-k * hours) to free chlorine measurements by
+    least squares on log(fc). Returns (fc0, k), with k per hour, or None
+    if there are not two positive measurements at different times.
+    '''
+    positive = fc > 0
+    hours, fc = hours[positive], fc[positive]
+    if len(np.unique(hours)) < 2:
+        return None
+    slope, intercept = np.polyfit(hours, np.log(fc), 1)
+    return float(np.exp(intercept)), float(-slope)
+
+
+def chlorine_dose(ppm, pool_volume, strength):
+    '''Returns the volume of chlorine with strength % available chlorine
+    which raises the free chlorine of pool_volume of water by ppm, in
+    the units of pool_volume'''
+    return ppm * pool_volume / (strength * 10000)
@@ -1,6 +1,11 @@
+import base64
+import binascii
+import calendar
 import functools
+import math
 import time
-from flask import jsonify, abort, request
+import zlib
+from flask import Response, jsonify, abort, make_response, request, stream_with_context
 from pool import app
 
 
@@ -13,6 +18,77 @@ def return_json(func):
     return inner
 
 
+def conditional(validator):
+    '''Decorator for GET views whose response only changes when their
+    validator does. validator() returns (etag, modified, max_age), or
+    None to serve the request without validators. etag and modified (s
+    since epoch) are sent with the response, and requests which already
+    have them get 304 Not Modified without running the view. If max_age
+    is given, clients may reuse the response for that many seconds without
+    asking; otherwise they must revalidate each time.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def inner(*a, **k):
+            if request.method not in ('GET', 'HEAD'):
+                return func(*a, **k)
+            validators = validator()
+            if validators is None:
+                return func(*a, **k)
+            etag, modified, max_age = validators
+            if _not_modified(etag, modified):
+                response = Response(status=304)
+            else:
+                response = make_response(func(*a, **k))
+            response.set_etag(etag, weak=True)
+            response.last_modified = _last_modified(modified)
+            if max_age is not None:
+                response.cache_control.public = True
+                response.cache_control.max_age = max_age
+            else:
+                response.cache_control.no_cache = True
+            return response
+        return inner
+    return decorator
+
+
+def _last_modified(modified):
+    '''Returns modified rounded to the second, as Last-Modified is sent.
+    It is rounded up once that second is over, as any later change will
+    be after it; until then, it is rounded down so that clients revalidate.
+    '''
+    rounded = math.ceil(modified)
+    return rounded if rounded <= time.time() else int(modified)
+
+
+def _not_modified(etag, modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    since = request.if_modified_since
+    return since is not None and modified < calendar.timegm(since.utctimetuple())
+
+
+def stream_response(chunks, mimetype):
+    '''Returns a response which streams chunks of text as they are
+    generated, within the request's context, and gzipped if the client
+    accepts it'''
+    chunks = stream_with_context(chunks)
+    if 'gzip' not in request.accept_encodings:
+        return Response(chunks, mimetype=mimetype)
+
+    def compress():
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            data = compressor.compress(chunk.encode())
+            if data:
+                yield data
+        yield compressor.flush()
+    response = Response(compress(), mimetype=mimetype)
+    response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
 def extract_int(name, default=None):
     '''Extracts an int from the query parameters'''
     try:
@@ -41,6 +117,22 @@ def extract_str(name, default=None):
         return default
 
 
+def encode_cursor(ts):
+    '''Encodes the ts of the last item on a page as an opaque token'''
+    return base64.urlsafe_b64encode(str(ts).encode()).decode()
+
+
+def extract_cursor(name, default=None):
+    '''Extracts a token made by encode_cursor from the query parameters,
+    and returns the ts it holds'''
+    try:
+        return int(base64.urlsafe_b64decode(request.args[name].encode()))
+    except KeyError:
+        return default
+    except (ValueError, binascii.Error):
+        abort(400, name + ' is not a valid cursor')
+
+
 def str_to_bool(string):
     return string.lower() in ['t', 'true', '1', 'y']
 
@@ -0,0 +1,165 @@
+'''
+Opt-in timing of requests, SQL queries, template rendering and scheduled
+jobs, aggregated into Prometheus style histograms; see
+backend/metrics.py, which serves them and hooks them into each request.
+Nothing is recorded unless the POOL_METRICS config is set. Each process
+keeps its own histograms.
+'''
+import bisect
+import os
+import threading
+import time
+
+import jinja2
+from flask import g, has_app_context
+
+from pool import app
+
+# whether to record anything; set POOL_METRICS in the environment to turn it on
+app.config.setdefault('POOL_METRICS', bool(os.environ.get('POOL_METRICS')))
+
+TIME_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                0.5, 1, 2.5, 5, 10]  # s
+COUNT_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500]
+SIZE_BUCKETS = [1000, 10000, 100000, 1000000, 10000000]  # bytes
+
+
+class Histogram():
+    '''Counts observations into buckets, separately for each set of labels.
+    An observation falls in the first bucket at least as large as it,
+    or in the +Inf bucket if there is none.
+    '''
+
+    def __init__(self, name, description, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = sorted(buckets)
+        # per label set, the count in each bucket (the last is +Inf) and sum
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._series.get(
+                key, ([0] * (len(self.buckets) + 1), 0))
+            counts[i] += 1
+            self._series[key] = (counts, total + value)
+
+    def render(self):
+        '''Returns the histogram in the Prometheus text format'''
+        with self._lock:
+            series = {k: (counts[:], total)
+                      for k, (counts, total) in self._series.items()}
+        lines = ['# HELP {} {}'.format(self.name, self.description),
+                 '# TYPE {} histogram'.format(self.name)]
+        for key in sorted(series):
+            counts, total = series[key]
+            cumulative = 0
+            for bound, count in zip(self.buckets + ['+Inf'], counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, _labels(key + (('le', bound),)), cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, _labels(key), total))
+            lines.append('{}_count{} {}'.format(self.name, _labels(key), cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(pairs):
+    if not any(pairs):
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', r'\"'))
+                          for k, v in pairs) + '}'
+
+
+REQUEST_SECONDS = Histogram(
+    'pool_request_seconds', 'Wall time of requests, until the view returns',
+    TIME_BUCKETS)
+REQUEST_QUERIES = Histogram(
+    'pool_request_sql_queries', 'SQL queries run by each request',
+    COUNT_BUCKETS)
+REQUEST_SQL_SECONDS = Histogram(
+    'pool_request_sql_seconds', 'Time each request spent in SQL queries',
+    TIME_BUCKETS)
+REQUEST_RENDER_SECONDS = Histogram(
+    'pool_request_render_seconds', 'Time each request spent rendering templates',
+    TIME_BUCKETS)
+RESPONSE_BYTES = Histogram(
+    'pool_response_bytes', 'Size of responses which are not streamed',
+    SIZE_BUCKETS)
+SQL_SECONDS = Histogram(
+    'pool_sql_query_seconds', 'Time taken by each SQL query, from anywhere',
+    TIME_BUCKETS)
+JOB_SECONDS = Histogram(
+    'pool_job_seconds', 'Time taken by each run of a scheduled job',
+    TIME_BUCKETS)
+HISTOGRAMS = [REQUEST_SECONDS, REQUEST_QUERIES, REQUEST_SQL_SECONDS,
+              REQUEST_RENDER_SECONDS, RESPONSE_BYTES, SQL_SECONDS, JOB_SECONDS]
+
+
+def enabled():
+    return app.config['POOL_METRICS']
+
+
+def _current():
+    '''Returns the totals of the request being served, if any'''
+    return g.get('_instrumentation') if has_app_context() else None
+
+
+def start_request():
+    '''Starts recording the current request'''
+    g._instrumentation = {
+        'start': time.perf_counter(),
+        'queries': 0,
+        'sql_s': 0.0,
+        'render_s': 0.0,
+    }
+
+
+def finish_request(endpoint, size):
+    '''Records the current request, which served endpoint with a response
+    of size bytes (None if it is streamed)'''
+    current = g.pop('_instrumentation', None)
+    if current is None:
+        return
+    REQUEST_SECONDS.observe(time.perf_counter() - current['start'],
+                            endpoint=endpoint)
+    REQUEST_QUERIES.observe(current['queries'], endpoint=endpoint)
+    REQUEST_SQL_SECONDS.observe(current['sql_s'], endpoint=endpoint)
+    REQUEST_RENDER_SECONDS.observe(current['render_s'], endpoint=endpoint)
+    if size is not None:
+        RESPONSE_BYTES.observe(size, endpoint=endpoint)
+
+
+def record_query(duration):
+    SQL_SECONDS.observe(duration)
+    current = _current()
+    if current is not None:
+        current['queries'] += 1
+        current['sql_s'] += duration
+
+
+def record_job(job_id, duration):
+    if enabled():
+        JOB_SECONDS.observe(duration, job=job_id)
+
+
+class TimedTemplate(jinja2.Template):
+    '''A Template which records how long it takes to render into the
+    current request; made the app's template class by backend/metrics.py'''
+
+    def render(self, *args, **kwargs):
+        current = _current()
+        if current is None:
+            return super().render(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            current['render_s'] += time.perf_counter() - start
+
+
+def render():
+    '''Returns every histogram in the Prometheus text format'''
+    return ''.join(h.render() for h in HISTOGRAMS)
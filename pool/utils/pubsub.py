@@ -0,0 +1,44 @@
+'''
+An in-process publish/subscribe hub, for pushing messages from whichever
+thread produces them to any number of consumers, such as open streams
+'''
+import queue
+import threading
+
+
+class Hub():
+    '''Fans out published messages to a queue per subscriber.
+    Subscribers which fall max_queued messages behind are dropped rather
+    than holding up publishers or growing without bound.
+    '''
+
+    def __init__(self, max_queued=1000):
+        self.max_queued = max_queued
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        '''Returns a queue.Queue which receives every message published
+        from now on, until it is unsubscribed or dropped'''
+        subscriber = queue.Queue(self.max_queued)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def is_subscribed(self, subscriber):
+        '''Returns false once a subscriber has been dropped'''
+        with self._lock:
+            return subscriber in self._subscribers
+
+    def publish(self, message):
+        '''Queues message for every subscriber, without blocking'''
+        with self._lock:
+            for subscriber in list(self._subscribers):
+                try:
+                    subscriber.put_nowait(message)
+                except queue.Full:
+                    self._subscribers.discard(subscriber)
@@ -0,0 +1,37 @@
+'''
+Precompiled serializers for rows of reading columns, such as the plain
+tuples returned by dal.iter_reading_rows. Each function takes the
+columns once and returns a function that serializes a single row.
+'''
+import operator
+
+
+def csv_writer(columns):
+    '''Returns a function which formats a row as a csv line.
+    Values are formatted with str, so nulls are written as None,
+    as Reading.__repr__ does.
+    '''
+    template = ','.join(['%s'] * len(columns)) + '\n'
+    return lambda row: template % tuple(row)
+
+
+def json_writer(columns):
+    '''Returns a function which converts a row into a dict by column.
+    A row may have more values than columns; extra values are dropped.
+    '''
+    return lambda row: dict(zip(columns, row))
+
+
+def datatable_writer(columns):
+    '''Returns a function which converts a row with named values,
+    such as from dal.get_readings_bucketed, into a Google DataTable row.
+    The row's ts becomes the first cell and the annotation the second,
+    followed by the values of columns.
+    '''
+    getters = [operator.attrgetter(c) for c in columns]
+
+    def write(row, annotation=None):
+        cells = [{'v': 'Date({})'.format(row.ts)}, {'v': annotation}]
+        cells += [{'v': get(row)} for get in getters]
+        return {'c': cells}
+    return write
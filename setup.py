@@ -9,6 +9,6 @@ setup(
         'flask_sqlalchemy',
         'wtforms',
         'apscheduler',
-        'requests',
+        'numpy',
     ]
 )